@@ -1,7 +1,20 @@
 import streamlit as st
 import openai
 import sqlite3
-import bcrypt
+import time
+import llm
+import metrics
+from auth import get_hash_pool, get_login_throttle
+from cache import get_response_cache
+from conversation import ConversationContext
+from db import UserProfile, get_db
+from jobs import get_feedback_jobs
+from shared import get_shared_cache
+from similarity import get_question_index
+from writer import get_writer
+
+# Start of this script run, for the rerun duration metric
+SCRIPT_STARTED = time.perf_counter()
 
 # Initialize OpenAI API
 try:
@@ -10,62 +23,31 @@ except KeyError:
     st.error("API Key not found in secrets.")
     st.stop()
 
-# Database setup
+# Database setup. Streamlit re-runs this script on every interaction, so the
+# migrations are cached to run once per server process.
+@st.cache_resource
+def init_database():
+    database = get_db()
+    database.migrate()
+    return database
+
 try:
-    conn = sqlite3.connect('users.db')
-    c = conn.cursor()
-
-    # User table
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            username TEXT PRIMARY KEY, 
-            password TEXT, 
-            interest TEXT, 
-            goal TEXT,
-            assessment_score INTEGER
-        )
-    ''')
-
-    # User questions table
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS user_questions (
-            id INTEGER PRIMARY KEY,
-            username TEXT, 
-            question TEXT, 
-            answer TEXT,
-            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-
-    # User challenges table
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS user_challenges (
-            id INTEGER PRIMARY KEY,
-            username TEXT, 
-            challenge TEXT, 
-            solution TEXT,
-            feedback TEXT,
-            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-
-    # Feedback table
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS user_feedback (
-            id INTEGER PRIMARY KEY,
-            username TEXT, 
-            question TEXT, 
-            answer TEXT,
-            feedback TEXT,
-            helpful INTEGER,
-            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    conn.commit()
+    db = init_database()
 except sqlite3.Error as e:
     st.error("Database error: " + str(e))
     st.stop()
 
+# Metrics are collected per server process and written out periodically
+@st.cache_resource
+def init_metrics():
+    metrics.REGISTRY.gauge_callback('write_queue_depth', lambda: get_writer().depth())
+    metrics.REGISTRY.gauge_callback('openai_queue_waiting', lambda: llm.get_rate_limiter().waiting)
+    metrics.REGISTRY.gauge_callback('openai_in_flight', lambda: llm.get_single_flight().in_flight())
+    metrics.REGISTRY.gauge_callback('response_cache_memory_entries', lambda: get_response_cache().stats()['memory_entries'])
+    return metrics.start_persisting(db)
+
+init_metrics()
+
 # At the beginning of the script, initialize the session state for username if it doesn't exist yet
 if 'username' not in st.session_state:
     st.session_state.username = None
@@ -76,66 +58,75 @@ if 'tutorial_content' not in st.session_state:
 if 'challenge_content' not in st.session_state:
     st.session_state.challenge_content = None
 
-def get_gpt_response(prompt, language=None, score=None):
-    try:
-        # Add context based on the language and score
-        context = ""
-        if language:
-            context += f"As a reminder, the user's primary coding language is {language}. "
-        if score is not None:
-            if score > 2:
-                context += f"The user has a good understanding of basic programming concepts. "
-            else:
-                context += f"The user needs more guidance on basic programming concepts. "
-        
-        # Combine context and prompt
-        full_prompt = context + prompt
-
-        response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": "You are a helpful coding assistant. Provide a concise answer with code snippets (where necessary)."},
-                {"role": "user", "content": full_prompt}
-            ],
-        )
-        return response['choices'][0]['message']['content']
-    except openai.error.OpenAIError as e:
+def show_ai_error(e):
+    # Requests are retried inside llm, so by now the failure isn't a blip;
+    # the rest of the page is skipped
+    if isinstance(e, (openai.error.Timeout, llm.RateLimitTimeout)):
+        st.error("The AI service is taking too long to respond. Please try again in a moment.")
+    else:
         st.error("There was an issue with the AI service. Please try again later.")
-        st.stop()
+    st.stop()
+
+def get_gpt_response(prompt, language=None, score=None, use_cache=False, history=None, kind='chat'):
+    # `kind` ('chat', 'tutorial', 'challenge' or 'feedback') picks the model,
+    # completion limit and timeout, see llm.ROUTES
+    try:
+        return llm.get_response(prompt, language, score, use_cache=use_cache, history=history, kind=kind)
+    except (openai.error.OpenAIError, llm.RateLimitTimeout) as e:
+        show_ai_error(e)
+
+def stream_gpt_response(prompt, language=None, score=None, use_cache=False, history=None, kind='chat'):
+    # Same as get_gpt_response, but yields the answer in chunks as they arrive
+    try:
+        yield from llm.stream_response(prompt, language, score, use_cache=use_cache, history=history, kind=kind)
+    except (openai.error.OpenAIError, llm.RateLimitTimeout) as e:
+        show_ai_error(e)
+
+def write_gpt_stream(chunks, label="", waiting_text="Thinking..."):
+    # Render a streamed answer progressively and return the full text once it's done
+    placeholder = st.empty()
+    placeholder.caption(waiting_text)
+    text = ""
+    last_render = 0.0
+    for chunk in chunks:
+        text += chunk
+        # Re-rendering on every token is wasteful, so refresh at most every 50ms
+        if time.monotonic() - last_render > 0.05:
+            placeholder.write(f"{label}{text}")
+            last_render = time.monotonic()
+    placeholder.write(f"{label}{text}")
+    return text
 
 def get_gpt_tutorial(topic, level, language):
-    prompt = f"Provide a {level} tutorial on {topic} for {language}."
-    response = get_gpt_response(prompt)
+    response = get_gpt_response(llm.tutorial_prompt(topic, level, language), use_cache=True, kind='tutorial')
     return response
 
 def get_gpt_challenge(topic, level, language):
-    prompt = f"Generate a {level} coding challenge related to {topic} for {language}."
-    response = get_gpt_response(prompt)
+    response = get_gpt_response(llm.challenge_prompt(topic, level, language), use_cache=True, kind='challenge')
     return response
 
 def tutorials_page():
     st.title("Tutorials")
     language = st.text_input("Choose a programming language (e.g Python, JavaScript, Java)")
     topic = st.text_input("Enter a topic (e.g. 'lists', 'functions')")
-    level = st.selectbox("Select difficulty level", ["beginner", "intermediate", "advanced"])
+    level = st.selectbox("Select difficulty level", llm.LEVELS)
     
     if st.button("Get Tutorial"):
         # Remove previous tutorial content from session state
         st.session_state.tutorial_content = None
-        with st.spinner('Generating tutorial...'):
-            st.session_state.tutorial_content = get_gpt_tutorial(topic, level, language)
-        st.write(st.session_state.tutorial_content)
+        chunks = stream_gpt_response(llm.tutorial_prompt(topic, level, language), use_cache=True, kind='tutorial')
+        st.session_state.tutorial_content = write_gpt_stream(chunks, waiting_text='Generating tutorial...')
 
 def challenges_page():
     st.title("Coding Challenges")
     language = st.text_input("Choose a programming language (e.g Python, JavaScript, Java)")
     topic = st.text_input("Enter a topic for the challenge (e.g. 'lists', 'OOP')")
-    level = st.selectbox("Select difficulty level", ["beginner", "intermediate", "advanced"])
+    level = st.selectbox("Select difficulty level", llm.LEVELS)
     
     if st.button("Get Challenge"):
-        with st.spinner('Generating challenge...'):
-            st.session_state.challenge_content = get_gpt_challenge(topic, level, language)
-        st.write(f"Challenge: {st.session_state.challenge_content}")
+        st.session_state.feedback_job = None
+        chunks = stream_gpt_response(llm.challenge_prompt(topic, level, language), use_cache=True, kind='challenge')
+        st.session_state.challenge_content = write_gpt_stream(chunks, "Challenge: ", 'Generating challenge...')
 
         # Once the challenge is generated, show the user input for solutions
         display_solution_input()
@@ -145,98 +136,158 @@ def challenges_page():
         # If the challenge already exists in the session state, show the user input for solutions
         display_solution_input()
 
+FEEDBACK_POLL_INTERVAL = 0.5
+
 def display_solution_input():
     user_solution = st.text_area("Write your solution here...")
-    if st.button("Submit Solution"):
-        if 'submit_solution' not in st.session_state:
-            st.session_state.submit_solution = False
-        if not st.session_state.submit_solution:
-            st.session_state.submit_solution = True
-            with st.spinner('Getting feedback...'):
-                # Ask GPT-3.5 Turbo for feedback on the submitted solution.
-                feedback_prompt = f"Provide feedback on this solution for this challenge: '{user_solution}'"
-                feedback = get_gpt_response(feedback_prompt)
-                st.write(f"Feedback: {feedback}")
-                # Store the user challenge and feedback
-                store_user_challenge(st.session_state.username, st.session_state.challenge_content, user_solution, feedback)
-        else:
-            st.session_state.submit_solution = False
+    if st.button("Submit Solution") and user_solution:
+        # Feedback is produced by a background job, so it is still generated
+        # and saved to the challenge history if the user leaves this page
+        st.session_state.feedback_job = get_feedback_jobs().submit(
+            st.session_state.username, st.session_state.challenge_content, user_solution)
+
+    if st.session_state.get('feedback_job'):
+        show_feedback_job(st.session_state.feedback_job)
+
+def show_feedback_job(job_id):
+    job = get_feedback_jobs().get(job_id)
+    if job is None:
+        return
+    if job.status == 'done':
+        st.write(f"Feedback: {job.feedback}")
+    elif job.status == 'failed':
+        st.error("There was an issue with the AI service. Please try again later.")
+    else:
+        poll_feedback_job(job_id)
+
+@st.fragment(run_every=FEEDBACK_POLL_INTERVAL)
+def poll_feedback_job(job_id):
+    # Only this panel reruns while the job is in progress, on a timer, so
+    # waiting neither blocks the session nor reruns the whole page
+    job = get_feedback_jobs().get(job_id)
+    if job is None or job.status in ('done', 'failed'):
+        # A full rerun shows the result and stops the polling
+        st.rerun()
+    if job.feedback:
+        st.write(f"Feedback: {job.feedback}")
+    st.caption('Getting feedback...')
 
 def register_user(username, password, interest, goal):
     try:
-        hashed_pw = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
-        with sqlite3.connect('users.db') as conn:
-            c = conn.cursor()
-            c.execute("INSERT INTO users (username, password, interest, goal) VALUES (?, ?, ?, ?)", 
-                      (username, hashed_pw, interest, goal))
-            conn.commit()
+        hashed_pw = get_hash_pool().hash_password(password)
+        db.create_user(username, hashed_pw, interest, goal)
     except sqlite3.Error as e:
         st.error("There was an issue with the database operation. Please try again later.")
 
 def check_user(username, password):
     try:
-        with sqlite3.connect('users.db') as conn:
-            c = conn.cursor()
-            c.execute("SELECT password FROM users WHERE username=?", (username,))
-            stored_pw = c.fetchone()
-            if stored_pw and bcrypt.checkpw(password.encode('utf-8'), stored_pw[0]):
-                return True
+        stored_pw = db.get_password_hash(username)
+        if stored_pw and get_hash_pool().check_password(password, stored_pw):
+            return True
         return False
     except sqlite3.Error as e:
         st.error("There was an issue with the database operation. Please try again later.")
         return False
 
 def store_assessment_result(username, score):
-    with sqlite3.connect('users.db') as conn:
-        c = conn.cursor()
-        c.execute("UPDATE users SET assessment_score = ? WHERE username = ?", (score, username))
-        conn.commit()
+    db.set_assessment_score(username, score)
+    shared = get_shared_cache()
+    if shared:
+        shared.invalidate_profile(username)
+    invalidate_user_profile()
 
 def user_exists(username):
-    with sqlite3.connect('users.db') as conn:
-        c = conn.cursor()
-        c.execute("SELECT username FROM users WHERE username=?", (username,))
-        return bool(c.fetchone())
+    return db.user_exists(username)
+
+def get_user_profile(username):
+    # The profile is read once per session and kept in session state, so
+    # ordinary reruns don't query the users table. Anything that changes the
+    # row must call invalidate_user_profile(), and in multi-process mode
+    # shared.invalidate_profile() too, which other processes pick up through
+    # the profile's generation.
+    shared = get_shared_cache()
+    generation = shared.profile_generation(username) if shared else None
+    profile = st.session_state.get('user_profile')
+    if profile is None or profile.username != username or st.session_state.get('user_profile_generation') != generation:
+        profile = load_user_profile(username, shared, generation)
+        st.session_state.user_profile = profile
+        st.session_state.user_profile_generation = generation
+    return profile
+
+def load_user_profile(username, shared, generation):
+    cached = shared.get_profile(username) if shared else None
+    if cached is not None:
+        return UserProfile(*cached)
+    profile = db.get_user_profile(username)
+    if shared and profile is not None:
+        shared.put_profile(username, profile, generation)
+    return profile
+
+def invalidate_user_profile():
+    st.session_state.user_profile = None
+
+# Session state that belongs to the logged-in user: the chat (which is sent to
+# OpenAI as context with the next question), the answer awaiting a rating,
+# generated content and the history views
+USER_SESSION_KEYS = ['conversation', 'chat_context', 'asked_questions', 'last_exchange', 'feedback_collected',
+                     'tutorial_content', 'challenge_content', 'feedback_job',
+                     'question_cursor', 'challenge_cursor', 'search_offset', 'history_search']
+
+def clear_user_state():
+    # Called whenever the user changes, so nothing carries over to the next
+    # person using the same browser session
+    for key in USER_SESSION_KEYS:
+        st.session_state.pop(key, None)
+    invalidate_user_profile()
 
 def has_taken_assessment(username):
-    with sqlite3.connect('users.db') as conn:
-        c = conn.cursor()
-        c.execute("SELECT assessment_score FROM users WHERE username=?", (username,))
-        score = c.fetchone()[0]
-        return score is not None
+    profile = get_user_profile(username)
+    return profile is not None and profile.assessment_score is not None
 
 def registration_page():
     st.title("Register")
     username = st.text_input("Username")
     password = st.text_input("Password", type="password")
     confirm_password = st.text_input("Confirm Password", type="password")
-    interest = st.selectbox("Your primary coding language", ["C#", "VBA", "Python", "Java", "SQL"])
+    interest = st.selectbox("Your primary coding language", llm.LANGUAGES)
     goal = st.text_area("What are your coding goals?")
     if st.button("Register"):
         if user_exists(username):
             st.error("User already exists!")
         elif password == confirm_password:
             register_user(username, password, interest, goal)
+            clear_user_state()
             st.session_state.username = username  # Update session state
             st.session_state.next_page = "Assessment"  # Indicate that the next page is Assessment
-            st.experimental_rerun()  # Rerun to navigate
+            st.rerun()  # Rerun to navigate
         else:
             st.error("Passwords do not match!")
 
+def client_address():
+    # Only available on newer Streamlit versions
+    context = getattr(st, 'context', None)
+    return getattr(context, 'ip_address', None)
+
 def login_page():
     st.title("Login")
     username = st.text_input("Username")
     password = st.text_input("Password", type="password")
     if st.button("Login"):
-        if check_user(username, password):
+        address = client_address()
+        if not get_login_throttle().allow(username, address):
+            st.error("Too many failed login attempts. Please wait a minute and try again.")
+        elif check_user(username, password):
+            get_login_throttle().reset(username)
             st.success("Logged in successfully!")
+            clear_user_state()  # Also loads a fresh profile for this login
             st.session_state.username = username  # Update the session state
             if not has_taken_assessment(username):
                 st.session_state.next_page = "Assessment"
             else:
                 st.session_state.next_page = "Chat"
-            st.experimental_rerun()
+            st.rerun()
         else:
+            get_login_throttle().record_failure(username, address)
             st.error("Invalid username or password")
     return "Login"  # By default, stay on the Login page
 
@@ -348,10 +399,7 @@ def assessment_page(username):
     st.title("Initial Assessment")
     
     # Fetch user's primary interest
-    with sqlite3.connect('users.db') as conn:
-        c = conn.cursor()
-        c.execute("SELECT interest FROM users WHERE username=?", (username,))
-        interest = c.fetchone()[0]
+    interest = get_user_profile(username).interest
 
     # Get questions and answers based on interest
     questions = question_bank[interest]["questions"]
@@ -367,7 +415,7 @@ def assessment_page(username):
         correct_count = sum([1 for question, answer in user_answers.items() if answer == correct_answers[question]])
         store_assessment_result(username, correct_count)  # Store the user's score
         st.session_state.next_page = "Feedback"  # Indicate that the next page is Feedback
-        st.experimental_rerun()
+        st.rerun()
 
 def chatbot_interface(username=None):
     st.title("TechItUp AI-Powered Coding Learning Chatbot")
@@ -379,6 +427,13 @@ def chatbot_interface(username=None):
     # Check if conversation exists in session state, otherwise initialize it as an empty list
     if 'conversation' not in st.session_state:
         st.session_state.conversation = []
+    # Earlier turns sent along with each question, kept within a token budget
+    if 'chat_context' not in st.session_state:
+        st.session_state.chat_context = ConversationContext()
+    # Questions already answered this session; the text input keeps its value
+    # across reruns, so this stops the same question being sent again
+    if 'asked_questions' not in st.session_state:
+        st.session_state.asked_questions = {item['content'] for item in st.session_state.conversation if item['role'] == 'user'}
 
     # Display the conversation history
     for item in st.session_state.conversation:
@@ -391,54 +446,68 @@ def chatbot_interface(username=None):
     new_input = st.text_input("Type your question here...")
 
     # Fetch user's primary interest and assessment score
-    with sqlite3.connect('users.db') as conn:
-        c = conn.cursor()
-        c.execute("SELECT interest, assessment_score FROM users WHERE username=?", (username,))
-        interest, score = c.fetchone()
+    profile = get_user_profile(username)
+    interest, score = profile.interest, profile.assessment_score
 
-    if new_input and new_input not in [item['content'] for item in st.session_state.conversation]:
+    if new_input and new_input not in st.session_state.asked_questions:
+        st.session_state.asked_questions.add(new_input)
         st.session_state.conversation.append({'role': 'user', 'content': new_input})
-        with st.spinner('Processing...'):
-            chatbot_response = get_gpt_response(new_input, interest, score)
+
+        history = st.session_state.chat_context.messages()
+
+        # A question that closely matches one asked before gets the stored
+        # answer. Every question is looked up: a follow-up that leans on this
+        # conversation ("what about dicts?") is too short or too different to
+        # reach the similarity threshold of a full earlier question.
+        stored_answer = get_question_index().find_answer(new_input, interest)
+        if stored_answer is not None:
+            chatbot_response = stored_answer
+            st.write(f"Chatbot: {chatbot_response}")
+            st.caption("Answered from a similar question asked before")
+        else:
+            prompt_tokens = llm.count_prompt_tokens(llm.build_messages(new_input, interest, score, history))
+
+            # Display the chatbot's response as it streams in
+            chatbot_response = write_gpt_stream(stream_gpt_response(new_input, interest, score, history=history), "Chatbot: ", 'Processing...')
+            st.caption(f"Prompt size: ~{prompt_tokens} tokens")
+        st.session_state.chat_context.add_turn(new_input, chatbot_response)
             
         # Store the user question and the chatbot's answer
         store_user_question(username, new_input, chatbot_response)
         
         st.session_state.conversation.append({'role': 'chatbot', 'content': chatbot_response})
 
-        # Display the chatbot's immediate response
-        st.write(f"Chatbot: {chatbot_response}")
+        # The answer the feedback buttons below refer to
+        st.session_state.last_exchange = (new_input, chatbot_response)
+        st.session_state.feedback_collected = False
 
-         # Feedback collection mechanism
-        if 'feedback_collected' not in st.session_state:
-            st.session_state.feedback_collected = False
+    # Feedback collection mechanism. The buttons are drawn on every run, not
+    # only the one that produced the answer, so the rerun a click causes
+    # still has them to report the click.
+    if 'feedback_collected' not in st.session_state:
+        st.session_state.feedback_collected = False
 
-        if not st.session_state.feedback_collected:
-            helpful = st.button("Yes, it was helpful")
-            not_helpful = st.button("No, it wasn't helpful")
+    last_exchange = st.session_state.get('last_exchange')
+    if last_exchange and not st.session_state.feedback_collected:
+        question, answer = last_exchange
+        helpful = st.button("Yes, it was helpful")
+        not_helpful = st.button("No, it wasn't helpful")
 
-            if helpful:
-                store_user_feedback(username, new_input, chatbot_response, None, 1)  # 1 indicates the answer was helpful
-                st.session_state.feedback_collected = True
+        if helpful:
+            store_user_feedback(username, question, answer, None, 1)  # 1 indicates the answer was helpful
+            st.session_state.feedback_collected = True
 
-            if not_helpful:
-                store_user_feedback(username, new_input, chatbot_response, None, 0)  # 0 indicates the answer was not helpful
-                st.session_state.feedback_collected = True
+        if not_helpful:
+            store_user_feedback(username, question, answer, None, 0)  # 0 indicates the answer was not helpful
+            st.session_state.feedback_collected = True
 
 
 def store_user_feedback(username, question, answer, feedback, helpful):
-    with sqlite3.connect('users.db') as conn:
-        c = conn.cursor()
-        c.execute("INSERT INTO user_feedback (username, question, answer, feedback, helpful) VALUES (?, ?, ?, ?, ?)", 
-                  (username, question, answer, feedback, helpful))
-        conn.commit()
+    get_writer().put_feedback(username, question, answer, feedback, helpful)
 
 def feedback_page(username):
     st.title("Assessment Feedback")
-    with sqlite3.connect('users.db') as conn:
-        c = conn.cursor()
-        c.execute("SELECT assessment_score FROM users WHERE username=?", (username,))
-        score = c.fetchone()[0]
+    score = get_user_profile(username).assessment_score
     st.success(f"You answered {score} out of 5 questions correctly!")
     if score > 2:
         st.write("Great job! You have a good understanding of basic programming concepts.")
@@ -446,61 +515,191 @@ def feedback_page(username):
         st.write("Keep practicing! You'll get better with time.")
     if st.button("Proceed to Chat"):
         st.session_state.next_page = "Chat"
-        st.experimental_rerun()
+        st.rerun()
 
 def store_user_question(username, question, answer):
-    with sqlite3.connect('users.db') as conn:
-        c = conn.cursor()
-        c.execute("INSERT INTO user_questions (username, question, answer) VALUES (?, ?, ?)", 
-                  (username, question, answer))
-        conn.commit()
-
-def store_user_challenge(username, challenge, solution, feedback):
-    with sqlite3.connect('users.db') as conn:
-        c = conn.cursor()
-        c.execute("INSERT INTO user_challenges (username, challenge, solution, feedback) VALUES (?, ?, ?, ?)", 
-                  (username, challenge, solution, feedback))
-        conn.commit()
+    get_writer().put_question(username, question, answer)
+
+HISTORY_PAGE_SIZE = 20
+
+def set_history_cursor(key, cursor):
+    st.session_state[key] = cursor
+
+def history_page_controls(key, rows, noun):
+    # `rows` holds one extra row when there is an older page to move to
+    if len(rows) > HISTORY_PAGE_SIZE:
+        last = rows[HISTORY_PAGE_SIZE - 1]
+        st.button(f"Load more {noun}", key=f"{key}_more", on_click=set_history_cursor, args=(key, (last[-1], last[0])))
+    if st.session_state[key] is not None:
+        st.button(f"Back to latest {noun}", key=f"{key}_latest", on_click=set_history_cursor, args=(key, None))
+
+def set_search_offset(offset):
+    st.session_state.search_offset = offset
+
+def search_results(username, query):
+    # Best matches first, one page of each kind at a time
+    offset = st.session_state.search_offset
+    questions = db.search_questions(username, query, HISTORY_PAGE_SIZE + 1, offset)
+    challenges = db.search_challenges(username, query, HISTORY_PAGE_SIZE + 1, offset)
+    if not questions and not challenges:
+        st.info("No matches in your history." if offset == 0 else "No more matches.")
+
+    if questions:
+        st.write("### Matching Questions")
+        for _, q, a, t in questions[:HISTORY_PAGE_SIZE]:
+            st.write(f"**{t}**")
+            st.write(f"**Q:** {q}")
+            st.write(f"**A:** {a}")
+            st.write("---")
+    if challenges:
+        st.write("### Matching Challenges")
+        for _, ch, sol, f, t in challenges[:HISTORY_PAGE_SIZE]:
+            st.write(f"**{t}**")
+            st.write(f"**Challenge:** {ch}")
+            st.write(f"**Your Solution:** {sol}")
+            st.write(f"**Feedback:** {f}")
+            st.write("---")
+
+    if len(questions) > HISTORY_PAGE_SIZE or len(challenges) > HISTORY_PAGE_SIZE:
+        st.button("More results", key="search_more", on_click=set_search_offset, args=(offset + HISTORY_PAGE_SIZE,))
+    if offset:
+        st.button("Previous results", key="search_previous", on_click=set_search_offset, args=(offset - HISTORY_PAGE_SIZE,))
 
 def progress_page(username):
     st.title("Your Progress")
-    
-    # Fetch user questions and answers
-    with sqlite3.connect('users.db') as conn:
-        c = conn.cursor()
-        c.execute("SELECT question, answer, timestamp FROM user_questions WHERE username = ? ORDER BY timestamp DESC", (username,))
-        questions = c.fetchall()
 
-        c.execute("SELECT challenge, solution, feedback, timestamp FROM user_challenges WHERE username = ? ORDER BY timestamp DESC", (username,))
-        challenges = c.fetchall()
+    # Only one page of each history is fetched and rendered at a time
+    if 'question_cursor' not in st.session_state:
+        st.session_state.question_cursor = None
+    if 'challenge_cursor' not in st.session_state:
+        st.session_state.challenge_cursor = None
+    if 'search_offset' not in st.session_state:
+        st.session_state.search_offset = 0
+
+    # Make sure anything still queued for writing shows up in the history
+    get_writer().flush()
+
+    # A new search starts again from the best matches
+    query = st.text_input("Search your history", key="history_search", on_change=set_search_offset, args=(0,))
+    if query.strip():
+        search_results(username, query)
+        return
+
+    # Fetch user questions and answers
+    questions = db.get_questions_page(username, HISTORY_PAGE_SIZE + 1, st.session_state.question_cursor)
+    challenges = db.get_challenges_page(username, HISTORY_PAGE_SIZE + 1, st.session_state.challenge_cursor)
 
     st.write("### Questions & Answers")
-    for q, a, t in questions:
+    for _, q, a, t in questions[:HISTORY_PAGE_SIZE]:
         st.write(f"**{t}**")
         st.write(f"**Q:** {q}")
         st.write(f"**A:** {a}")
         st.write("---")
+    history_page_controls('question_cursor', questions, "questions")
 
     st.write("### Challenges & Feedback")
-    for ch, sol, f, t in challenges:
+    for _, ch, sol, f, t in challenges[:HISTORY_PAGE_SIZE]:
         st.write(f"**{t}**")
         st.write(f"**Challenge:** {ch}")
         st.write(f"**Your Solution:** {sol}")
         st.write(f"**Feedback:** {f}")
         st.write("---")
+    history_page_controls('challenge_cursor', challenges, "challenges")
+
+def is_admin(username):
+    # Admins are listed in the secrets, e.g. [admin] usernames = ["alice"]
+    return username in st.secrets.get("admin", {}).get("usernames", [])
+
+def format_metric(name, value):
+    if value is None:
+        return ""
+    # Token counts are shown as they are; everything else is in seconds
+    return f"{value:.0f}" if name.endswith('_tokens') else f"{value * 1000:.1f} ms"
+
+def metrics_page():
+    st.title("Metrics")
+    st.caption("Collected in this server process since it started")
+
+    st.write("### Timings")
+    rows = metrics.REGISTRY.summary()
+    for row in rows:
+        for column in ('mean', 'p50', 'p95', 'p99'):
+            row[column] = format_metric(row['metric'], row[column])
+    st.table(rows)
+
+    snapshot = metrics.REGISTRY.snapshot()
+    st.write("### Counters")
+    st.table([{'metric': name, 'labels': ", ".join(f"{k}={v}" for k, v in sorted(labels.items())), 'value': value}
+              for name, labels, value in sorted(snapshot['counters'], key=lambda c: (c[0], sorted(c[1].items())))])
+    st.write("### Gauges")
+    st.table([{'metric': name, 'value': value} for name, _, value in sorted(snapshot['gauges'])])
+
+    last = db.get_last_metrics_snapshot()
+    if last:
+        st.caption(f"Last persisted {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(last[0]))} by process {last[1]}")
+    st.download_button("Download Prometheus export", metrics.REGISTRY.prometheus_text(), file_name="metrics.prom", mime="text/plain")
+
+ANALYTICS_PERIODS = {"Last 7 days": 7, "Last 30 days": 30, "Last 90 days": 90}
+ANALYTICS_TOP_USERS = 20
+
+def helpful_rate(helpful, not_helpful):
+    rated = helpful + not_helpful
+    return f"{helpful / rated:.0%}" if rated else ""
+
+def analytics_page():
+    st.title("Analytics")
+    # Everything here comes from the daily aggregate tables, so the page costs
+    # the same however large the history tables get
+    period = st.selectbox("Period", list(ANALYTICS_PERIODS))
+    username = st.text_input("Username (leave empty for all users)").strip() or None
+    since = time.strftime('%Y-%m-%d', time.gmtime(time.time() - (ANALYTICS_PERIODS[period] - 1) * 86400))
+
+    activity = db.get_daily_activity(since, username)
+    feedback = db.get_daily_feedback(since, username)
+    helpful = sum(row[2] for row in feedback)
+    not_helpful = sum(row[3] for row in feedback)
+    columns = st.columns(3)
+    columns[0].metric("Questions", sum(row[1] for row in activity))
+    columns[1].metric("Challenges", sum(row[2] for row in activity))
+    columns[2].metric("Helpful answers", helpful_rate(helpful, not_helpful) or "-")
+
+    st.write("### Activity per day")
+    if activity:
+        st.bar_chart([{'day': day, 'questions': q, 'challenges': c} for day, q, c in activity], x='day', y=['questions', 'challenges'])
+    else:
+        st.info("No activity in this period.")
+
+    st.write("### Helpful rate by language")
+    by_language = {}
+    for _, language, h, n in feedback:
+        totals = by_language.setdefault(language or "Unknown", [0, 0])
+        totals[0] += h
+        totals[1] += n
+    st.table([{'language': language, 'helpful': h, 'not helpful': n, 'helpful rate': helpful_rate(h, n)}
+              for language, (h, n) in sorted(by_language.items())])
+    st.write("### Helpful rate by day")
+    st.table([{'day': day, 'language': language or "Unknown", 'helpful': h, 'not helpful': n, 'helpful rate': helpful_rate(h, n)}
+              for day, language, h, n in reversed(feedback)])
+
+    if username is None:
+        st.write("### Most active raters")
+        st.table([{'username': name, 'helpful': h, 'not helpful': n, 'helpful rate': helpful_rate(h, n)}
+                  for name, h, n in db.get_feedback_by_user(since, ANALYTICS_TOP_USERS)])
 
 def logout():
     st.session_state.username = None  # Reset the username in session state
-    st.experimental_rerun()  # Rerun the app to show the login/register page
+    clear_user_state()
+    st.rerun()  # Rerun the app to show the login/register page
 
 if __name__ == "__main__":
+    page = "Login"
     try:
         if not st.session_state.username:
-            action = st.radio("Choose an action", ["Login", "Register"])
+            action = page = st.radio("Choose an action", ["Login", "Register"])
             if action == "Login":
                 next_page = login_page()
                 if next_page != "Login":
-                    st.experimental_rerun()
+                    st.rerun()
             elif action == "Register":
                 registration_page()
         else:
@@ -509,9 +708,13 @@ if __name__ == "__main__":
 
             # If the user is logged in and has taken the assessment, show the sidebar
             if st.session_state.username and user_has_taken_assessment:
-                sidebar_option = st.sidebar.selectbox("Choose an option", ["Chat", "Tutorials", "Challenges", "Progress", "Logout"])
+                options = ["Chat", "Tutorials", "Challenges", "Progress", "Logout"]
+                if is_admin(st.session_state.username):
+                    options[-1:-1] = ["Analytics", "Metrics"]
+                sidebar_option = st.sidebar.selectbox("Choose an option", options)
             else:
                 sidebar_option = "Chat"  # Default option for users not logged in or those who haven't taken the assessment
+            page = sidebar_option
                 
             if sidebar_option == "Chat":
                 if 'next_page' not in st.session_state or st.session_state.next_page == "Assessment":
@@ -526,7 +729,15 @@ if __name__ == "__main__":
                 challenges_page()
             elif sidebar_option == "Progress":
                 progress_page(st.session_state.username)
+            elif sidebar_option == "Metrics" and is_admin(st.session_state.username):
+                metrics_page()
+            elif sidebar_option == "Analytics" and is_admin(st.session_state.username):
+                analytics_page()
             elif sidebar_option == "Logout":
                 logout()
     except Exception as e:
+        metrics.inc('script_errors', page=page, error=type(e).__name__)
         st.error("An unexpected error occurred: " + str(e))
+    finally:
+        # Also recorded when the run ends early with st.stop() or a rerun
+        metrics.observe('script_run_seconds', time.perf_counter() - SCRIPT_STARTED, page=page)
@@ -0,0 +1,185 @@
+import itertools
+import multiprocessing
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import bcrypt
+
+import metrics
+
+# bcrypt work factor for new hashes. Existing hashes keep the factor they
+# were created with, so this can be raised at any time.
+BCRYPT_ROUNDS = int(os.environ.get('TECHITUP_BCRYPT_ROUNDS', 12))
+# Hashing is CPU bound, so there's no point running more of it at once than
+# there are cores; extra requests wait for a free worker
+HASH_WORKERS = int(os.environ.get('TECHITUP_HASH_WORKERS', os.cpu_count() or 1))
+
+# Failed logins allowed per username and per client address within the window
+MAX_FAILURES_PER_USER = 5
+MAX_FAILURES_PER_ADDRESS = 20
+THROTTLE_WINDOW = 60
+
+
+def _hash_password(password, rounds):
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds))
+
+
+def _check_password(password, hashed):
+    return bcrypt.checkpw(password.encode('utf-8'), hashed)
+
+
+class HashPool:
+    """Runs bcrypt in a bounded pool of worker processes.
+
+    Keeps the hashing off the Streamlit script threads (and the GIL), so a
+    burst of logins uses every core without stalling other sessions. Falls
+    back to hashing inline if the pool can't be used.
+    """
+
+    def __init__(self, workers=HASH_WORKERS, rounds=BCRYPT_ROUNDS):
+        self.workers = max(1, workers)
+        self.rounds = rounds
+        self._executor = None
+        self._lock = threading.Lock()
+        # Bounds the work queued behind the pool so a login storm can't build
+        # an unbounded backlog
+        self._slots = threading.BoundedSemaphore(self.workers * 2)
+
+    @metrics.timed('bcrypt_seconds')
+    def hash_password(self, password):
+        return self._run(_hash_password, password, self.rounds)
+
+    @metrics.timed('bcrypt_seconds')
+    def check_password(self, password, hashed):
+        if isinstance(hashed, str):
+            hashed = hashed.encode('utf-8')
+        return self._run(_check_password, password, hashed)
+
+    @metrics.timed('bcrypt_seconds')
+    def hash_passwords(self, passwords):
+        # A whole batch spread over every worker, e.g. for a bulk import;
+        # the hashes come back in the same order
+        executor = self._get_executor()
+        if executor is not None:
+            try:
+                chunksize = max(1, len(passwords) // (self.workers * 4))
+                return list(executor.map(_hash_password, passwords, itertools.repeat(self.rounds), chunksize=chunksize))
+            except BrokenProcessPool:
+                metrics.inc('bcrypt_pool_failures')
+                self.shutdown()
+        return [_hash_password(password, self.rounds) for password in passwords]
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+    def _run(self, fn, *args):
+        with self._slots:
+            executor = self._get_executor()
+            if executor is None:
+                return fn(*args)
+            try:
+                return executor.submit(fn, *args).result()
+            except BrokenProcessPool:
+                metrics.inc('bcrypt_pool_failures')
+                self.shutdown()
+                return fn(*args)
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                # Workers are forked: a spawned worker would re-import the main
+                # module, which under Streamlit is the app script itself.
+                # Without fork, hashing stays inline.
+                if 'fork' not in multiprocessing.get_all_start_methods():
+                    return None
+                try:
+                    context = multiprocessing.get_context('fork')
+                    self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+                except OSError:
+                    return None
+            return self._executor
+
+
+class LoginThrottle:
+    """Counts failed logins per username and per client address over a sliding window."""
+
+    def __init__(self, max_per_user=MAX_FAILURES_PER_USER, max_per_address=MAX_FAILURES_PER_ADDRESS, window=THROTTLE_WINDOW):
+        self.max_per_user = max_per_user
+        self.max_per_address = max_per_address
+        self.window = window
+        self._failures = {}
+        self._next_sweep = time.monotonic() + window
+        self._lock = threading.Lock()
+
+    def allow(self, username, address=None):
+        with self._lock:
+            if self._count(('user', username)) >= self.max_per_user:
+                return False
+            if address and self._count(('address', address)) >= self.max_per_address:
+                return False
+            return True
+
+    def record_failure(self, username, address=None):
+        now = time.monotonic()
+        with self._lock:
+            # Only the latest failures up to the limit matter, so each key
+            # keeps at most that many
+            self._failures.setdefault(('user', username), deque(maxlen=self.max_per_user)).append(now)
+            if address:
+                self._failures.setdefault(('address', address), deque(maxlen=self.max_per_address)).append(now)
+            if now >= self._next_sweep:
+                self._sweep(now)
+
+    def _sweep(self, now):
+        # Caller holds self._lock. Drops keys with no failures left in the
+        # window, at most once per window, so names and addresses that are
+        # never tried again don't stay in memory.
+        cutoff = now - self.window
+        for key in [key for key, attempts in self._failures.items() if attempts[-1] < cutoff]:
+            del self._failures[key]
+        self._next_sweep = now + self.window
+
+    def reset(self, username):
+        with self._lock:
+            self._failures.pop(('user', username), None)
+
+    def _count(self, key):
+        # Caller holds self._lock
+        attempts = self._failures.get(key)
+        if not attempts:
+            return 0
+        cutoff = time.monotonic() - self.window
+        while attempts and attempts[0] < cutoff:
+            attempts.popleft()
+        if not attempts:
+            del self._failures[key]
+            return 0
+        return len(attempts)
+
+
+_hash_pool = None
+_login_throttle = None
+_singletons_lock = threading.Lock()
+
+
+def get_hash_pool():
+    global _hash_pool
+    with _singletons_lock:
+        if _hash_pool is None:
+            _hash_pool = HashPool()
+        return _hash_pool
+
+
+def get_login_throttle():
+    global _login_throttle
+    with _singletons_lock:
+        if _login_throttle is None:
+            _login_throttle = LoginThrottle()
+        return _login_throttle
@@ -0,0 +1,352 @@
+"""Benchmark the app end to end with scripted sessions.
+
+Each simulated user drives app.py headlessly through Streamlit's AppTest:
+register, take the assessment, ask chat questions, get a tutorial, solve a
+challenge and open the progress page. Afterwards every user logs in again
+from a new session. Users run concurrently in worker processes, OpenAI is
+replaced by a local fake_openai.py server and everything runs against a
+fresh database, so runs are repeatable:
+
+    python bench.py --users 20 --concurrency 4 --latency 0.3 --output bench.json
+
+With --shared the workers run in multi-process mode (see shared.py), sharing
+the response and profile cache and coordinating their database writes.
+
+Results (rerun latency percentiles, DB queries per second, login throughput
+and memory per session) are written as JSON for comparing two versions of
+the app.
+"""
+import argparse
+import json
+import multiprocessing
+import multiprocessing.util
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from streamlit.testing.v1 import AppTest
+
+import fake_openai
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app.py')
+
+CHAT_QUESTIONS = [
+    "What is a list comprehension and when should I use one?",
+    "How do I reverse a string without using built-in functions?",
+    "What is the difference between a class and an object?",
+    "How do I read a CSV file line by line?",
+    "Why does my recursive function hit the maximum recursion depth?",
+    "What does a hash map do and how fast are lookups?",
+    "How do I handle exceptions when opening a file?",
+    "What is the difference between a list and a tuple?",
+]
+PASSWORD = "benchmark-password"
+TOPICS = ["lists", "loops", "functions", "recursion", "classes", "dictionaries"]
+# Poll reruns while waiting for challenge feedback, at most, and the pause
+# between them; the page itself refreshes the feedback panel on a timer,
+# which AppTest doesn't run
+MAX_FEEDBACK_POLLS = 60
+FEEDBACK_POLL_INTERVAL = 0.5
+
+
+def percentiles(values):
+    if not values:
+        return {'count': 0}
+    ordered = sorted(values)
+
+    def rank(q):
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    return {
+        'count': len(ordered),
+        'mean': sum(ordered) / len(ordered),
+        'p50': rank(0.50),
+        'p95': rank(0.95),
+        'p99': rank(0.99),
+        'max': ordered[-1],
+    }
+
+
+def rss_bytes():
+    # Resident set size of this process (Linux), or None elsewhere
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(APP_PATH),
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Session:
+    """One simulated user, timing every rerun it causes."""
+
+    def __init__(self, username, timeout):
+        self.username = username
+        self.at = AppTest.from_file(APP_PATH, default_timeout=timeout)
+        self.at.secrets['openai'] = {'api_key': 'fake'}
+        self.timings = {}
+        self.errors = {}
+
+    def run(self, step, action=None):
+        # `action` sets widget values or clicks on the current page, then the
+        # script is rerun as the browser would
+        started = time.perf_counter()
+        (action() if action else self.at).run()
+        self.timings.setdefault(step, []).append(time.perf_counter() - started)
+        for error in [e.value for e in self.at.error] + [e.message for e in self.at.exception]:
+            key = f"{step}: {error[:200]}"
+            self.errors[key] = self.errors.get(key, 0) + 1
+
+    def widget(self, kind, label):
+        for element in getattr(self.at, kind):
+            if element.label == label:
+                return element
+        shown = [e.value for e in self.at.title] + [e.value for e in self.at.error] + [e.message for e in self.at.exception]
+        raise LookupError(f"{self.username}: no {kind} labelled {label!r} on the page showing {shown}")
+
+    def go_to(self, page):
+        self.run(f'open_{page.lower()}', lambda: self.at.sidebar.selectbox[0].select(page))
+
+
+def user_journey(session, rng, questions):
+    # Register; the new account goes straight on to the assessment
+    session.run('load')
+    session.run('choose_register', lambda: session.widget('radio', "Choose an action").set_value("Register"))
+    interest = rng.choice(["Python", "Java", "SQL"])
+
+    def register():
+        session.widget('text_input', "Username").input(session.username)
+        session.widget('text_input', "Password").input(PASSWORD)
+        session.widget('text_input', "Confirm Password").input(PASSWORD)
+        session.widget('selectbox', "Your primary coding language").set_value(interest)
+        session.widget('text_area', "What are your coding goals?").input("Get better at coding")
+        return session.widget('button', "Register").click()
+    session.run('register', register)
+    session.run('assessment')
+
+    def answer_assessment():
+        for radio in session.at.radio:
+            radio.set_value(rng.choice(radio.options))
+        return session.widget('button', "Submit").click()
+    session.run('submit_assessment', answer_assessment)
+    session.run('assessment_feedback')
+    session.run('proceed_to_chat', lambda: session.widget('button', "Proceed to Chat").click())
+    session.run('open_chat')
+
+    for question in rng.sample(CHAT_QUESTIONS, questions):
+        session.run('chat', lambda: session.widget('text_input', "Type your question here...").input(question))
+
+    session.go_to("Tutorials")
+
+    def get_tutorial():
+        session.widget('text_input', "Choose a programming language (e.g Python, JavaScript, Java)").input(interest)
+        session.widget('text_input', "Enter a topic (e.g. 'lists', 'functions')").input(rng.choice(TOPICS))
+        return session.widget('button', "Get Tutorial").click()
+    session.run('tutorial', get_tutorial)
+
+    session.go_to("Challenges")
+
+    def get_challenge():
+        session.widget('text_input', "Choose a programming language (e.g Python, JavaScript, Java)").input(interest)
+        session.widget('text_input', "Enter a topic for the challenge (e.g. 'lists', 'OOP')").input(rng.choice(TOPICS))
+        return session.widget('button', "Get Challenge").click()
+    session.run('challenge', get_challenge)
+
+    def submit_solution():
+        session.widget('text_area', "Write your solution here...").input("def solve(items):\n    return sorted(items)")
+        return session.widget('button', "Submit Solution").click()
+    session.run('submit_solution', submit_solution)
+    for _ in range(MAX_FEEDBACK_POLLS):
+        if not any(c.value == 'Getting feedback...' for c in session.at.caption):
+            break
+        time.sleep(FEEDBACK_POLL_INTERVAL)
+        session.run('feedback_poll')
+
+    session.go_to("Progress")
+
+
+def login(session):
+    session.run('load')
+
+    def submit():
+        session.widget('text_input', "Username").input(session.username)
+        session.widget('text_input', "Password").input(PASSWORD)
+        return session.widget('button', "Login").click()
+    session.run('login', submit)
+    return session.at.session_state['username'] == session.username
+
+
+# Sessions stay referenced for the life of a worker, as they would in a
+# server, so the memory they hold shows up in its RSS
+_sessions = []
+
+
+def _init_worker():
+    # The app's bcrypt pool runs in child processes of this worker, which
+    # multiprocessing waits for when the worker exits. It has to be shut
+    # down before multiprocessing closes the queues it uses (priority 10).
+    from auth import get_hash_pool
+    multiprocessing.util.Finalize(None, lambda: get_hash_pool().shutdown(), exitpriority=100)
+
+
+def _journey_task(username, seed, questions, timeout):
+    # Runs in a worker process
+    import metrics
+    db_queries_before = metrics.REGISTRY.observations('db_query_seconds')
+    session = Session(username, timeout)
+    _sessions.append(session)
+    user_journey(session, random.Random(seed), questions)
+    return {
+        'timings': session.timings,
+        'errors': session.errors,
+        'db_queries': metrics.REGISTRY.observations('db_query_seconds') - db_queries_before,
+        'worker': os.getpid(),
+        'sessions_held': len(_sessions),
+        'rss': rss_bytes(),
+    }
+
+
+def _memory_per_session(journeys):
+    # RSS growth per additional session held by a worker. A worker's first
+    # session also pays for importing Streamlit and the app, so it's the
+    # baseline rather than a sample.
+    by_worker = {}
+    for journey in journeys:
+        by_worker.setdefault(journey['worker'], []).append(journey)
+    growth = []
+    for runs in by_worker.values():
+        first = min(runs, key=lambda j: j['sessions_held'])
+        last = max(runs, key=lambda j: j['sessions_held'])
+        if last is not first and first['rss'] and last['rss']:
+            growth.append((last['rss'] - first['rss']) / (last['sessions_held'] - first['sessions_held']))
+    return sum(growth) / len(growth) if growth else None
+
+
+def _login_task(username, timeout):
+    session = Session(username, timeout)
+    return {'timings': session.timings, 'errors': session.errors, 'logged_in': login(session)}
+
+
+def _merge(results):
+    timings, errors = {}, {}
+    for result in results:
+        for step, values in result['timings'].items():
+            timings.setdefault(step, []).extend(values)
+        for error, count in result['errors'].items():
+            errors[error] = errors.get(error, 0) + count
+    return timings, errors
+
+
+def run_benchmark(args):
+    server = fake_openai.start_server(latency=args.latency, token_delay=args.token_delay, answer_words=args.answer_words)
+    # Read by the openai library when the workers import it
+    os.environ['OPENAI_API_BASE'] = server.api_base
+    prefix = f"bench{int(time.time())}"
+    usernames = [f"{prefix}_{i}" for i in range(args.users)]
+
+    # AppTest runs one script at a time per process (it swaps Streamlit's
+    # global runtime for each run), so concurrent users are worker
+    # processes sharing the database and the fake OpenAI server, like a
+    # multi-process deployment. They're spawned rather than forked so they
+    # can't inherit a lock held by one of this process's threads.
+    context = multiprocessing.get_context('spawn')
+    # Tasks are sent by module name: in the workers, Streamlit replaces
+    # __main__ with the app script while it runs
+    import bench
+    with ProcessPoolExecutor(max_workers=args.concurrency, mp_context=context, initializer=bench._init_worker) as executor:
+        started = time.perf_counter()
+        journeys = list(executor.map(bench._journey_task, usernames, [args.seed + i for i in range(args.users)],
+                                     [args.questions] * args.users, [args.timeout] * args.users))
+        journey_seconds = time.perf_counter() - started
+
+        # Every user logs in again from a new session, all at once
+        started = time.perf_counter()
+        logins = list(executor.map(bench._login_task, usernames, [args.timeout] * args.users))
+        login_seconds = time.perf_counter() - started
+
+    timings, errors = _merge(journeys + logins)
+    # Waiting for background feedback isn't rerun latency, so polls are
+    # reported separately
+    rerun_timings = [t for step, values in timings.items() if step != 'feedback_poll' for t in values]
+    db_queries = sum(j['db_queries'] for j in journeys)
+    logged_in = sum(result['logged_in'] for result in logins)
+    return {
+        'commit': git_commit(),
+        'config': {k: v for k, v in vars(args).items() if k != 'output'},
+        'journey_seconds': journey_seconds,
+        'rerun_latency': percentiles(rerun_timings),
+        'rerun_latency_by_step': {step: percentiles(values) for step, values in sorted(timings.items())},
+        'db': {
+            'queries': db_queries,
+            'queries_per_second': db_queries / journey_seconds,
+        },
+        'login': {
+            'attempts': len(logins),
+            'succeeded': logged_in,
+            'seconds': login_seconds,
+            'per_second': logged_in / login_seconds,
+        },
+        'memory': {
+            'per_session_bytes': _memory_per_session(journeys),
+        },
+        'openai_requests': server.requests,
+        'errors': errors,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the TechItUp app with simulated users.")
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--concurrency', type=int, default=4, help="worker processes, i.e. users active at once")
+    parser.add_argument('--questions', type=int, default=3, help="chat questions per user")
+    parser.add_argument('--latency', type=float, default=0.2, help="fake OpenAI seconds before the first byte")
+    parser.add_argument('--token-delay', type=float, default=0.005, help="fake OpenAI seconds between streamed chunks")
+    parser.add_argument('--answer-words', type=int, default=80)
+    parser.add_argument('--bcrypt-rounds', type=int, help="bcrypt work factor (default: the app's)")
+    parser.add_argument('--timeout', type=float, default=60, help="seconds a single rerun may take")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--shared', action='store_true', help="run the workers in multi-process mode with a shared cache")
+    parser.add_argument('--db', help="database file to use (default: a new one in a temporary directory)")
+    parser.add_argument('--output', default='bench.json')
+    args = parser.parse_args(argv)
+    args.questions = min(args.questions, len(CHAT_QUESTIONS))
+
+    # The app reads these when its modules are first imported
+    workdir = tempfile.mkdtemp(prefix='techitup-bench-')
+    os.environ['TECHITUP_DB'] = args.db or os.path.join(workdir, 'users.db')
+    os.environ['TECHITUP_METRICS_FILE'] = os.path.join(workdir, 'metrics.prom')
+    if args.shared:
+        os.environ['TECHITUP_SHARED_DIR'] = os.path.join(workdir, 'shared')
+    if args.bcrypt_rounds:
+        os.environ['TECHITUP_BCRYPT_ROUNDS'] = str(args.bcrypt_rounds)
+    os.environ['OPENAI_API_KEY'] = 'fake'
+
+    results = run_benchmark(args)
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
+
+    latency = results['rerun_latency']
+    print(f"{args.users} users in {results['journey_seconds']:.1f}s; rerun p50 {latency['p50'] * 1000:.0f} ms, "
+          f"p95 {latency['p95'] * 1000:.0f} ms, p99 {latency['p99'] * 1000:.0f} ms")
+    print(f"{results['db']['queries_per_second']:.0f} DB queries/s, {results['login']['per_second']:.1f} logins/s")
+    if results['memory']['per_session_bytes'] is not None:
+        print(f"~{results['memory']['per_session_bytes'] / 1024:.0f} KiB per session")
+    for error, count in results['errors'].items():
+        print(f"  {count}x {error}")
+    print(f"Results written to {args.output}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
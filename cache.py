@@ -0,0 +1,138 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+import metrics
+from db import get_db
+from shared import get_shared_cache
+
+# Cache defaults: a week of freshness, a small hot set in memory and a
+# bounded number of rows in the database.
+DEFAULT_TTL = 7 * 24 * 60 * 60
+DEFAULT_MEMORY_SIZE = 256
+DEFAULT_MAX_ROWS = 5000
+
+
+def normalize_prompt(prompt):
+    # Case and whitespace differences shouldn't produce separate cache entries
+    return " ".join((prompt or "").lower().split())
+
+
+def score_bucket(score):
+    # Mirrors the two levels of context get_gpt_response adds for a score
+    if score is None:
+        return None
+    return "good" if score > 2 else "guided"
+
+
+def make_cache_key(prompt, language=None, score=None, model=None):
+    parts = [normalize_prompt(prompt), (language or "").strip().lower(), score_bucket(score), model]
+    return hashlib.sha256(json.dumps(parts).encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    """Two-tier response cache: an in-process LRU in front of the response_cache table.
+
+    Entries expire after `ttl` seconds. The memory tier holds at most
+    `memory_size` entries and the database tier at most `max_rows`; the least
+    recently used entries are evicted first in both.
+
+    In multi-process mode the second tier is the shared cache file instead of
+    the response_cache table, and memory entries are dropped as soon as
+    another process deletes or clears them (see shared.py).
+    """
+
+    def __init__(self, db=None, ttl=DEFAULT_TTL, memory_size=DEFAULT_MEMORY_SIZE, max_rows=DEFAULT_MAX_ROWS, shared=None):
+        self.shared = shared or get_shared_cache()
+        self.db = db or self.shared or get_db()
+        self.ttl = ttl
+        self.memory_size = memory_size
+        self.max_rows = max_rows
+        self.hits = 0
+        self.memory_hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                response, created_at, generation = entry
+                if now - created_at < self.ttl and generation == self._generation(key):
+                    self._memory.move_to_end(key)
+                    self.hits += 1
+                    self.memory_hits += 1
+                    metrics.inc('response_cache_lookups', result='memory_hit')
+                    return response
+                del self._memory[key]
+
+        row = self.db.get_cached_response(key)
+        if row and now - row[1] < self.ttl:
+            self.db.touch_cached_response(key, now)
+        elif row:
+            self.db.delete_cached_response(key)
+            row = None
+
+        with self._lock:
+            if row is None:
+                self.misses += 1
+                metrics.inc('response_cache_lookups', result='miss')
+                return None
+            self.hits += 1
+            metrics.inc('response_cache_lookups', result='hit')
+            self._remember(key, row[0], row[1])
+        return row[0]
+
+    def contains(self, key):
+        # Whether a fresh entry exists, without touching it or the hit counters
+        row = self.db.get_cached_response(key)
+        return row is not None and time.time() - row[1] < self.ttl
+
+    def put(self, key, response):
+        now = time.time()
+        with self._lock:
+            self._remember(key, response, now)
+        self.db.put_cached_response(key, response, now, now - self.ttl, self.max_rows)
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+        self.db.clear_cached_responses()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'memory_hits': self.memory_hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'memory_entries': len(self._memory),
+            }
+
+    def _generation(self, key):
+        return self.shared.response_generation(key) if self.shared else None
+
+    def _remember(self, key, response, created_at):
+        # Caller holds self._lock
+        self._memory[key] = (response, created_at, self._generation(key))
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_size:
+            self._memory.popitem(last=False)
+
+
+_response_cache = None
+_response_cache_lock = threading.Lock()
+
+
+def get_response_cache():
+    # One response cache per process, shared by every session
+    global _response_cache
+    with _response_cache_lock:
+        if _response_cache is None:
+            _response_cache = ResponseCache()
+        return _response_cache
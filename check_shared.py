@@ -0,0 +1,146 @@
+"""Check multi-process mode (shared.py) with real processes.
+
+Starts worker processes against a fresh database and shared directory and
+checks what single-process runs can't show:
+
+- clearing or replacing a cached response in one process stops another
+  process serving its in-memory copy
+- invalidating a profile in one process is seen by another, and a profile
+  read before the invalidation can't be put back afterwards
+- several processes writing to users.db at once all succeed, with no rows
+  lost
+
+    python check_shared.py --writers 6 --rows 200
+
+Exits with status 1 if any check fails.
+"""
+import argparse
+import multiprocessing
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+PROFILE_USER = 'shared-check'
+
+
+def _cache_reader(commands, replies):
+    # Answers lookups from its own ResponseCache and SharedCache, so its
+    # in-memory tier is separate from the main process's
+    import shared
+    from cache import ResponseCache
+    cache = ResponseCache()
+    for command, key in iter(commands.get, None):
+        if command == 'response':
+            value = cache.get(key)
+            replies.put((value, cache.memory_hits))
+        elif command == 'profile':
+            replies.put(shared.get_shared_cache().get_profile(key))
+
+
+def _writer(number, rows, errors):
+    from db import get_db
+    db = get_db()
+    try:
+        for i in range(rows):
+            db.add_questions([(f'writer-{number}', f'question {i}', 'answer ' * 200)] * 5)
+            db.set_assessment_score(PROFILE_USER, i % 5)
+    except Exception as e:
+        errors.put(f"writer {number}: {e!r}")
+
+
+class Checks:
+    def __init__(self):
+        self.failed = 0
+
+    def expect(self, description, actual, expected):
+        ok = actual == expected
+        self.failed += not ok
+        print(f"{'ok  ' if ok else 'FAIL'} {description}" + ("" if ok else f": got {actual!r}, expected {expected!r}"))
+
+
+def check_invalidation(ctx, checks):
+    import shared
+    from cache import ResponseCache
+    cache = ResponseCache()
+    store = shared.get_shared_cache()
+    commands, replies = ctx.Queue(), ctx.Queue()
+    reader = ctx.Process(target=_cache_reader, args=(commands, replies))
+    reader.start()
+
+    def ask(command, key):
+        commands.put((command, key))
+        return replies.get(timeout=30)
+
+    try:
+        cache.put('greeting', 'hello')
+        checks.expect("response put in one process is read by another", ask('response', 'greeting')[0], 'hello')
+        checks.expect("second read is served from the reader's memory", ask('response', 'greeting'), ('hello', 1))
+        cache.clear()
+        checks.expect("clear in one process drops the other's memory copy", ask('response', 'greeting')[0], None)
+        cache.put('greeting', 'hello again')
+        checks.expect("replaced response is read by the other process", ask('response', 'greeting')[0], 'hello again')
+
+        profile = [PROFILE_USER, 'Python', 'goal', 3]
+        generation = store.profile_generation(PROFILE_USER)
+        store.put_profile(PROFILE_USER, profile, generation)
+        checks.expect("profile put in one process is read by another", ask('profile', PROFILE_USER), profile)
+        store.invalidate_profile(PROFILE_USER)
+        checks.expect("invalidated profile is gone in the other process", ask('profile', PROFILE_USER), None)
+        # A profile read before the invalidation carries the old generation
+        store.put_profile(PROFILE_USER, [PROFILE_USER, 'Python', 'goal', 1], generation)
+        checks.expect("stale profile put after the invalidation is ignored", ask('profile', PROFILE_USER), None)
+    finally:
+        commands.put(None)
+        reader.join()
+
+
+def check_concurrent_writes(ctx, checks, writers, rows):
+    errors = ctx.Queue()
+    started = time.perf_counter()
+    processes = [ctx.Process(target=_writer, args=(n, rows, errors)) for n in range(writers)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    print(f"     {writers} writer processes took {time.perf_counter() - started:.2f}s")
+
+    failures = []
+    while not errors.empty():
+        failures.append(errors.get())
+    checks.expect("concurrent writers raise no errors", failures, [])
+    checks.expect("writer exit codes", [process.exitcode for process in processes], [0] * writers)
+    with sqlite3.connect(os.environ['TECHITUP_DB']) as conn:
+        written = conn.execute("SELECT count(*) FROM user_questions WHERE username LIKE 'writer-%'").fetchone()[0]
+    checks.expect("every written row is in users.db", written, writers * rows * 5)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check TechItUp's multi-process mode with real processes.")
+    parser.add_argument('--writers', type=int, default=6, help="processes writing to users.db at once")
+    parser.add_argument('--rows', type=int, default=200, help="write transactions per writer")
+    args = parser.parse_args(argv)
+
+    # The app reads these when its modules are first imported, and the
+    # spawned processes inherit them
+    workdir = tempfile.mkdtemp(prefix='techitup-shared-check-')
+    os.environ['TECHITUP_DB'] = os.path.join(workdir, 'users.db')
+    os.environ['TECHITUP_SHARED_DIR'] = os.path.join(workdir, 'shared')
+
+    from db import get_db
+    db = get_db()
+    db.migrate()
+    db.create_user(PROFILE_USER, b'unused', 'Python', 'goal')
+
+    # spawn rather than fork: every process opens its own connections and maps
+    ctx = multiprocessing.get_context('spawn')
+    checks = Checks()
+    check_invalidation(ctx, checks)
+    check_concurrent_writes(ctx, checks, args.writers, args.rows)
+    print(f"{checks.failed} checks failed" if checks.failed else "All checks passed")
+    return 1 if checks.failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
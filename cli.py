@@ -0,0 +1,282 @@
+"""Command-line maintenance tasks for TechItUp.
+
+    python cli.py warm topics.json --concurrency 8
+    python cli.py archive --older-than-days 90
+    python cli.py import-users cohort.csv
+    python cli.py export-history history.jsonl --user alice --user bob
+
+Run `python cli.py --help` for the full list of commands.
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import openai
+
+import llm
+from auth import get_hash_pool
+from cache import get_response_cache, make_cache_key
+from db import ARCHIVE_AFTER_DAYS, get_db
+
+SECRETS_PATH = os.path.join('.streamlit', 'secrets.toml')
+
+
+def configure_openai(api_key=None, api_base=None):
+    # Same key the app uses, unless one is given or set in OPENAI_API_KEY
+    if api_base:
+        openai.api_base = api_base
+    openai.api_key = api_key or openai.api_key or _secrets_api_key()
+    if not openai.api_key:
+        sys.exit(f"No OpenAI API key: pass --api-key, set OPENAI_API_KEY or add it to {SECRETS_PATH}")
+
+
+def _secrets_api_key():
+    try:
+        import tomllib
+        with open(SECRETS_PATH, 'rb') as f:
+            return tomllib.load(f)['openai']['api_key']
+    except (ImportError, OSError, KeyError):
+        return None
+
+
+# Cache warming
+
+def load_manifest(path):
+    # Either a JSON object with "topics" and optional "languages", "levels"
+    # and "kinds", or a text file with one topic per line
+    with open(path, encoding='utf-8') as f:
+        if path.endswith('.json'):
+            manifest = json.load(f)
+        else:
+            manifest = {'topics': [line.strip() for line in f if line.strip() and not line.startswith('#')]}
+    return {
+        'topics': manifest['topics'],
+        'languages': manifest.get('languages', llm.LANGUAGES),
+        'levels': manifest.get('levels', llm.LEVELS),
+        'kinds': manifest.get('kinds', ['tutorial', 'challenge']),
+    }
+
+
+def warm_jobs(manifest):
+    prompts = {'tutorial': llm.tutorial_prompt, 'challenge': llm.challenge_prompt}
+    for kind in manifest['kinds']:
+        for language in manifest['languages']:
+            for level in manifest['levels']:
+                for topic in manifest['topics']:
+                    yield f"{kind}: {level} {topic} ({language})", kind, prompts[kind](topic, level, language)
+
+
+def routed_model(kind, prompt):
+    # The model the app would use for this prompt, which is part of its cache key
+    return llm.route(kind, llm.count_prompt_tokens(llm.build_messages(prompt))).model
+
+
+def warm(args):
+    configure_openai(args.api_key, args.api_base)
+    get_db().migrate()
+    cache = get_response_cache()
+
+    # Anything already in the response store is skipped, so an interrupted
+    # run picks up where it left off
+    jobs = list(warm_jobs(load_manifest(args.manifest)))
+    pending = [(name, kind, prompt) for name, kind, prompt in jobs
+               if not cache.contains(make_cache_key(prompt, model=routed_model(kind, prompt)))]
+    skipped = len(jobs) - len(pending)
+    print(f"{len(jobs)} prompts in manifest, {skipped} already cached, {len(pending)} to generate "
+          f"with concurrency {args.concurrency}")
+
+    failures = []
+    done = 0
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        futures = {executor.submit(llm.get_response, prompt, use_cache=True, kind=kind): name for name, kind, prompt in pending}
+        for future in as_completed(futures):
+            try:
+                future.result()
+                done += 1
+            except Exception as e:
+                failures.append((futures[future], e))
+            finished = done + len(failures)
+            if finished % 10 == 0 or finished == len(pending):
+                elapsed = time.monotonic() - started
+                print(f"  {finished}/{len(pending)} ({finished / elapsed:.1f}/s)")
+
+    elapsed = time.monotonic() - started
+    print(f"Generated {done}, skipped {skipped}, failed {len(failures)} in {elapsed:.1f}s "
+          f"({done / elapsed if elapsed else 0:.2f} prompts/s)")
+    for name, error in failures:
+        # Some OpenAI errors repeat the whole response in their message
+        print(f"  FAILED {name}: {type(error).__name__}: {str(error)[:200]}")
+    return 1 if failures else 0
+
+
+# Archiving
+
+def archive(args):
+    db = get_db()
+    db.migrate()
+    size_before = os.path.getsize(db.path)
+    started = time.monotonic()
+    questions, challenges = db.archive_history(args.older_than_days)
+    print(f"Archived {questions} questions and {challenges} challenges older than {args.older_than_days} days "
+          f"in {time.monotonic() - started:.1f}s")
+    if not args.no_vacuum:
+        freed = db.vacuum(convert=args.convert)
+        if freed is None:
+            print(f"{db.path} predates incremental vacuum, so the freed pages stay in the file for reuse. "
+                  f"Stop the app and run this once with --convert to return them to the filesystem from now on.")
+            return 0
+        # The WAL holds the moved pages until it is checkpointed
+        with db.connection() as conn:
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        print(f"Freed {freed} pages; {db.path} went from {size_before / 1e6:.1f} MB to {os.path.getsize(db.path) / 1e6:.1f} MB")
+    return 0
+
+
+# Cohort import and history export
+
+# Field names of each kind of exported history record
+EXPORT_FIELDS = {
+    'question': ('id', 'question', 'answer', 'timestamp'),
+    'challenge': ('id', 'challenge', 'solution', 'feedback', 'timestamp'),
+    'feedback': ('id', 'question', 'answer', 'feedback', 'helpful', 'timestamp'),
+}
+
+
+def _parse_json_line(line):
+    # None for a line that isn't valid JSON, so it's reported like any other
+    # invalid record
+    try:
+        return json.loads(line)
+    except ValueError:
+        return None
+
+
+def load_users(path):
+    # A CSV file with a header row, or JSON Lines (.jsonl); either way with
+    # username, password, interest and goal. utf-8-sig skips the byte order
+    # mark spreadsheet programs put at the start of exported CSV files.
+    with open(path, encoding='utf-8-sig', newline='') as f:
+        if path.endswith(('.jsonl', '.ndjson')):
+            return [_parse_json_line(line) for line in f if line.strip()]
+        return list(csv.DictReader(f))
+
+
+def validate_users(records):
+    # Returns the usable (username, password, interest, goal) rows and a list
+    # of (record number, problem) for the rest
+    rows, problems, seen = [], [], set()
+    for number, record in enumerate(records, 1):
+        if not isinstance(record, dict):
+            problems.append((number, "not a JSON object with username, password, interest and goal"))
+            continue
+        if not all(isinstance(record.get(field) or '', str) for field in ('username', 'password', 'interest', 'goal')):
+            problems.append((number, "username, password, interest and goal must be strings"))
+            continue
+        username = (record.get('username') or '').strip()
+        password = record.get('password') or ''
+        interest = (record.get('interest') or '').strip()
+        if not username or not password:
+            problems.append((number, "username and password are required"))
+        elif interest not in llm.LANGUAGES:
+            # The assessment only has questions for these languages
+            problems.append((number, f"interest {interest!r} is not one of {', '.join(llm.LANGUAGES)}"))
+        elif username in seen:
+            problems.append((number, f"username {username!r} appears more than once"))
+        else:
+            seen.add(username)
+            rows.append((username, password, interest, record.get('goal') or ''))
+    return rows, problems
+
+
+def import_users(args):
+    db = get_db()
+    db.migrate()
+    rows, problems = validate_users(load_users(args.path))
+    for number, problem in problems:
+        print(f"  record {number}: {problem}")
+    if problems and not args.skip_invalid:
+        print(f"{len(problems)} invalid records, nothing imported (use --skip-invalid to import the rest)")
+        return 1
+
+    # Users that already exist are left alone, so an import can be re-run
+    existing = db.get_existing_usernames([row[0] for row in rows])
+    rows = [row for row in rows if row[0] not in existing]
+    if args.dry_run:
+        print(f"Would import {len(rows)} users, {len(existing)} already exist, {len(problems)} invalid")
+        return 0
+
+    started = time.monotonic()
+    pool = get_hash_pool()
+    try:
+        hashes = pool.hash_passwords([row[1] for row in rows])
+    finally:
+        pool.shutdown()
+    hashed = time.monotonic()
+    db.create_users([(username, hashed_pw, interest, goal) for (username, _, interest, goal), hashed_pw in zip(rows, hashes)])
+    print(f"Imported {len(rows)} users ({len(existing)} already existed, {len(problems)} invalid skipped); "
+          f"hashing took {hashed - started:.1f}s on {pool.workers} workers, inserting {time.monotonic() - hashed:.2f}s")
+    return 0
+
+
+def export_history(args):
+    db = get_db()
+    db.migrate()
+    usernames = args.users or db.iter_usernames()
+    out = sys.stdout if args.output == '-' else open(args.output, 'w', encoding='utf-8')
+    users = records = 0
+    try:
+        # One JSON object per line, written as the rows are read
+        for username in usernames:
+            users += 1
+            for kind, row in db.iter_user_history(username):
+                out.write(json.dumps({'type': kind, 'username': username, **dict(zip(EXPORT_FIELDS[kind], row))}) + "\n")
+                records += 1
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    print(f"Exported {records} records for {users} users", file=sys.stderr)
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="TechItUp maintenance commands.")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    warm_parser = commands.add_parser('warm', help="pre-generate tutorials and challenges into the response cache")
+    warm_parser.add_argument('manifest', help="JSON manifest or text file with one topic per line")
+    warm_parser.add_argument('--concurrency', type=int, default=4)
+    warm_parser.add_argument('--api-key', help="OpenAI API key (defaults to OPENAI_API_KEY or the Streamlit secrets)")
+    warm_parser.add_argument('--api-base', help="OpenAI API base URL, e.g. a fake_openai.py endpoint")
+    warm_parser.set_defaults(handler=warm)
+
+    archive_parser = commands.add_parser('archive', help="move old question and challenge history into compressed archive tables")
+    archive_parser.add_argument('--older-than-days', type=int, default=ARCHIVE_AFTER_DAYS,
+                                help=f"archive history older than this (default {ARCHIVE_AFTER_DAYS}, or TECHITUP_ARCHIVE_AFTER_DAYS)")
+    archive_parser.add_argument('--no-vacuum', action='store_true', help="leave the freed pages in the database file")
+    archive_parser.add_argument('--convert', action='store_true',
+                                help="enable incremental vacuum on an existing database with a one-off full VACUUM "
+                                     "(locks the database while it runs; stop the app first)")
+    archive_parser.set_defaults(handler=archive)
+
+    import_parser = commands.add_parser('import-users', help="register a cohort of users from a CSV or JSON Lines file")
+    import_parser.add_argument('path', help="CSV with a header row, or .jsonl; fields username, password, interest, goal")
+    import_parser.add_argument('--skip-invalid', action='store_true', help="import the valid records even if some are invalid")
+    import_parser.add_argument('--dry-run', action='store_true', help="check the file without importing anything")
+    import_parser.set_defaults(handler=import_users)
+
+    export_parser = commands.add_parser('export-history', help="write users' questions, challenges and feedback as JSON Lines")
+    export_parser.add_argument('output', help="output file, or - for stdout")
+    export_parser.add_argument('--user', dest='users', action='append', help="user to export (repeatable; default all users)")
+    export_parser.set_defaults(handler=export_history)
+
+    args = parser.parse_args(argv)
+    return args.handler(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,66 @@
+import os
+
+from llm import estimate_tokens
+
+# Tokens of earlier conversation sent with each chat request, including the
+# rolling summary, and the share of that budget the summary may use
+CONTEXT_TOKEN_BUDGET = int(os.environ.get('TECHITUP_CONTEXT_TOKENS', 1500))
+SUMMARY_SHARE = 0.25
+
+# How much of each compacted turn survives in the summary
+SUMMARY_QUESTION_CHARS = 120
+SUMMARY_ANSWER_CHARS = 160
+
+
+def _first_sentence(text, limit):
+    text = " ".join(text.split())
+    end = text.find(". ")
+    if 0 < end < limit:
+        return text[:end + 1]
+    return text if len(text) <= limit else text[:limit].rstrip() + "..."
+
+
+class ConversationContext:
+    """Multi-turn chat context kept within a token budget.
+
+    The most recent turns are sent verbatim. When they no longer fit the
+    budget the oldest ones are compacted into one-line summaries (the start
+    of the question and of the answer), and the oldest summary lines are
+    dropped once the summary outgrows its share. Compaction is local, so
+    long sessions cost no extra API calls and the prompt size stays flat.
+    """
+
+    def __init__(self, budget=CONTEXT_TOKEN_BUDGET, summary_share=SUMMARY_SHARE):
+        self.budget = budget
+        self.summary_budget = int(budget * summary_share)
+        self.turns = []
+        self.summary = []
+
+    def add_turn(self, question, answer):
+        self.turns.append((question, answer))
+        while self.turns and self._tokens() > self.budget:
+            self._compact(*self.turns.pop(0))
+
+    def messages(self):
+        # Earlier conversation as chat messages, to go between the system
+        # prompt and the new question
+        messages = []
+        if self.summary:
+            lines = "\n".join(f"- {line}" for line in self.summary)
+            messages.append({"role": "system", "content": f"Summary of the earlier conversation:\n{lines}"})
+        for question, answer in self.turns:
+            messages.append({"role": "user", "content": question})
+            messages.append({"role": "assistant", "content": answer})
+        return messages
+
+    def _compact(self, question, answer):
+        self.summary.append(f"User asked: {_first_sentence(question, SUMMARY_QUESTION_CHARS)} "
+                            f"Answer: {_first_sentence(answer, SUMMARY_ANSWER_CHARS)}")
+        while len(self.summary) > 1 and self._summary_tokens() > self.summary_budget:
+            self.summary.pop(0)
+
+    def _summary_tokens(self):
+        return sum(estimate_tokens(line) for line in self.summary)
+
+    def _tokens(self):
+        return self._summary_tokens() + sum(estimate_tokens(q) + estimate_tokens(a) for q, a in self.turns)
@@ -0,0 +1,929 @@
+import json
+import os
+import queue
+import re
+import sqlite3
+import threading
+import zlib
+from contextlib import contextmanager, nullcontext
+from typing import Iterator, List, NamedTuple, Optional, Set, Tuple
+
+import shared
+from metrics import timed
+
+DB_PATH = os.environ.get('TECHITUP_DB', 'users.db')
+
+# How long a connection waits on a locked database before giving up
+BUSY_TIMEOUT_MS = 5000
+# Idle connections kept around for reuse
+POOL_SIZE = 8
+# Compiled statements kept per connection; every query below is a constant
+# string, so a pooled connection compiles each one only once
+STATEMENT_CACHE_SIZE = 128
+# History older than this is moved to the compressed archive tables by
+# `python cli.py archive`
+ARCHIVE_AFTER_DAYS = int(os.environ.get('TECHITUP_ARCHIVE_AFTER_DAYS', 90))
+# Rows moved per archive transaction, so the app's writers never wait long
+ARCHIVE_BATCH_SIZE = 500
+# Free pages returned to the filesystem per vacuum transaction, likewise
+VACUUM_BATCH_PAGES = 1000
+
+_SEARCH_TERM = re.compile(r"\w+")
+
+
+def _fts_phrase(text: str) -> str:
+    return '"' + text.replace('"', '""') + '"'
+
+
+def search_expression(username: str, text: str, columns: Tuple[str, ...]) -> Optional[str]:
+    # Turns what the user typed into an FTS5 query: every word has to match
+    # in one of `columns`, the last one as a prefix so partly typed words
+    # find results. Operators and punctuation are dropped rather than
+    # interpreted. None if there is nothing to search for.
+    terms = [_fts_phrase(term) for term in _SEARCH_TERM.findall(text or "")]
+    if not terms:
+        return None
+    terms[-1] += '*'
+    # Without the column filter the words would also match the indexed
+    # username, and a search for part of your own name would return
+    # everything you ever asked
+    expression = f"{{{' '.join(columns)}}} : ({' '.join(terms)})"
+    # Narrow to the user's rows inside the index; the join on the base table
+    # checks the exact username
+    if _SEARCH_TERM.search(username):
+        expression = f"username : {_fts_phrase(username)} AND ({expression})"
+    return expression
+
+
+def _pack(*fields: Optional[str]) -> bytes:
+    return zlib.compress(json.dumps(fields).encode('utf-8'))
+
+
+def _unpack(data: bytes) -> list:
+    return json.loads(zlib.decompress(data))
+
+
+def _search_terms(text: str) -> List[str]:
+    return [term.lower() for term in _SEARCH_TERM.findall(text or "")]
+
+
+def _is_hit(word: str, terms: List[str]) -> bool:
+    # Mirrors search_expression: the last term matches as a prefix
+    word = word.lower()
+    return word in terms[:-1] or word.startswith(terms[-1])
+
+
+def _highlight(text: Optional[str], terms: List[str]) -> Optional[str]:
+    # highlight() for archived rows, whose text isn't stored in their index.
+    # Words matched only through stemming ("lists" for "list") aren't marked.
+    if not text or not terms:
+        return text
+    return _SEARCH_TERM.sub(lambda m: f"**{m.group()}**" if _is_hit(m.group(), terms) else m.group(), text)
+
+
+def _snippet(text: Optional[str], terms: List[str], tokens: int = 48) -> Optional[str]:
+    # snippet() for archived rows: up to `tokens` words starting a little
+    # before the first match, highlighted, with ... where text was cut
+    if not text or not terms:
+        return text
+    words = list(_SEARCH_TERM.finditer(text))
+    if len(words) <= tokens:
+        return _highlight(text, terms)
+    first = next((i for i, m in enumerate(words) if _is_hit(m.group(), terms)), 0)
+    start = max(0, min(first - tokens // 4, len(words) - tokens))
+    end = start + tokens
+    begin = words[start].start() if start else 0
+    finish = words[end - 1].end() if end < len(words) else len(text)
+    return ("..." if start else "") + _highlight(text[begin:finish], terms) + ("..." if end < len(words) else "")
+
+
+def _best_first(hot: list, archived: list, limit: int, offset: int, render) -> list:
+    # Merges search hits from the hot tables, (id, ..., rank), with hits from
+    # the archive, (id, data, timestamp, rank), by BM25 rank, and unpacks only
+    # the archived rows that make it onto the page with render(row, fields)
+    merged = sorted([(row, False) for row in hot] + [(row, True) for row in archived],
+                    key=lambda item: item[0][-1])[offset:offset + limit]
+    return [render(row, _unpack(row[1])) if packed else row[:-1] for row, packed in merged]
+
+
+def _iter_rows(cursor: sqlite3.Cursor, batch_size: int) -> Iterator[tuple]:
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            return
+        yield from rows
+
+
+def _newest_first(hot: list, archived: list, limit: int) -> list:
+    # Merges a page of hot rows, (id, ..., timestamp), with a page of archived
+    # rows, (id, data, timestamp), decompressing only the archived rows that
+    # make it onto the merged page
+    merged = sorted([(row, False) for row in hot] + [(row, True) for row in archived],
+                    key=lambda item: (item[0][-1], item[0][0]), reverse=True)[:limit]
+    return [(row[0], *_unpack(row[1]), row[2]) if packed else row for row, packed in merged]
+
+
+# Schema migrations, applied in order. Each one runs in its own transaction
+# and is recorded in schema_version, so a database is only ever moved forward
+# and never re-runs a step it has already taken.
+
+
+def _migration_1_base_tables(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            username TEXT PRIMARY KEY,
+            password TEXT,
+            interest TEXT,
+            goal TEXT,
+            assessment_score INTEGER
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS user_questions (
+            id INTEGER PRIMARY KEY,
+            username TEXT,
+            question TEXT,
+            answer TEXT,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS user_challenges (
+            id INTEGER PRIMARY KEY,
+            username TEXT,
+            challenge TEXT,
+            solution TEXT,
+            feedback TEXT,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS user_feedback (
+            id INTEGER PRIMARY KEY,
+            username TEXT,
+            question TEXT,
+            answer TEXT,
+            feedback TEXT,
+            helpful INTEGER,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+
+def _migration_2_feedback_answer_column(conn):
+    # Some early databases were created with user_feedback.chatbot_response
+    # instead of user_feedback.answer
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(user_feedback)")]
+    if 'answer' not in columns and 'chatbot_response' in columns:
+        conn.execute("ALTER TABLE user_feedback RENAME COLUMN chatbot_response TO answer")
+
+
+def _migration_3_response_cache(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS response_cache (
+            key TEXT PRIMARY KEY,
+            response TEXT,
+            created_at REAL,
+            last_access REAL
+        )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_response_cache_last_access ON response_cache (last_access)")
+
+
+def _migration_4_history_indexes(conn):
+    # Covers the per-user, newest-first history queries; the rowid that every
+    # index carries doubles as the tie-breaker for keyset pagination
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_user_questions_username_timestamp ON user_questions (username, timestamp)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_user_challenges_username_timestamp ON user_challenges (username, timestamp)")
+
+
+def _migration_5_feedback_jobs(conn):
+    # Solution-feedback requests processed by background workers. `feedback`
+    # holds the partial text while a job runs and the final text once done.
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS feedback_jobs (
+            id INTEGER PRIMARY KEY,
+            username TEXT,
+            challenge TEXT,
+            solution TEXT,
+            status TEXT DEFAULT 'pending',
+            feedback TEXT,
+            error TEXT,
+            attempts INTEGER DEFAULT 0,
+            claimed_at REAL,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_feedback_jobs_status ON feedback_jobs (status, id)")
+
+
+def _migration_6_metrics_snapshots(conn):
+    # Periodic JSON dumps of each process's in-memory metrics registry
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS metrics_snapshots (
+            id INTEGER PRIMARY KEY,
+            taken_at REAL,
+            pid INTEGER,
+            data TEXT
+        )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_metrics_snapshots_taken_at ON metrics_snapshots (taken_at)")
+
+
+def _migration_7_history_search(conn):
+    # Full-text indexes over the history tables. They are external-content
+    # tables: the text lives only in user_questions/user_challenges and the
+    # triggers keep the indexes in step with every insert, update and delete.
+    # username is indexed too, so a search only reads the user's own postings.
+    for table, columns in (('user_questions', ('question', 'answer')),
+                           ('user_challenges', ('challenge', 'solution', 'feedback'))):
+        all_columns = ('username',) + columns
+        names = ", ".join(all_columns)
+        new_values = ", ".join(f"new.{c}" for c in all_columns)
+        old_values = ", ".join(f"old.{c}" for c in all_columns)
+        conn.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS {table}_fts USING fts5({names}, content='{table}', content_rowid='id', tokenize='porter unicode61')")
+        conn.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {table}_fts_insert AFTER INSERT ON {table} BEGIN
+                INSERT INTO {table}_fts (rowid, {names}) VALUES (new.id, {new_values});
+            END
+        """)
+        conn.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {table}_fts_delete AFTER DELETE ON {table} BEGIN
+                INSERT INTO {table}_fts ({table}_fts, rowid, {names}) VALUES ('delete', old.id, {old_values});
+            END
+        """)
+        conn.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {table}_fts_update AFTER UPDATE ON {table} BEGIN
+                INSERT INTO {table}_fts ({table}_fts, rowid, {names}) VALUES ('delete', old.id, {old_values});
+                INSERT INTO {table}_fts (rowid, {names}) VALUES (new.id, {new_values});
+            END
+        """)
+        # Index the rows that are already there
+        conn.execute(f"INSERT INTO {table}_fts ({table}_fts) VALUES ('rebuild')")
+
+
+def _migration_8_daily_aggregates(conn):
+    # Per-day counters maintained by triggers as history rows are inserted, so
+    # reports read a handful of rows instead of scanning the event tables.
+    # Days are UTC, like the timestamp defaults. Feedback is counted under the
+    # user's primary language at the time it was given.
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS daily_activity (
+            username TEXT NOT NULL,
+            day TEXT NOT NULL,
+            questions INTEGER NOT NULL DEFAULT 0,
+            challenges INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (username, day)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_daily_activity_day ON daily_activity (day)")
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS daily_feedback (
+            username TEXT NOT NULL,
+            language TEXT NOT NULL,
+            day TEXT NOT NULL,
+            helpful INTEGER NOT NULL DEFAULT 0,
+            not_helpful INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (username, language, day)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_daily_feedback_day ON daily_feedback (day)")
+
+    for table, column in (('user_questions', 'questions'), ('user_challenges', 'challenges')):
+        conn.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {table}_daily_activity AFTER INSERT ON {table} BEGIN
+                INSERT INTO daily_activity (username, day, {column}) VALUES (coalesce(new.username, ''), date(new.timestamp), 1)
+                ON CONFLICT (username, day) DO UPDATE SET {column} = {column} + 1;
+            END
+        """)
+        conn.execute(f"""
+            INSERT INTO daily_activity (username, day, {column})
+            SELECT coalesce(username, ''), date(timestamp), count(*) FROM {table} WHERE true GROUP BY 1, 2
+            ON CONFLICT (username, day) DO UPDATE SET {column} = {column} + excluded.{column}
+        """)
+
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS user_feedback_daily_feedback AFTER INSERT ON user_feedback BEGIN
+            INSERT INTO daily_feedback (username, language, day, helpful, not_helpful)
+            VALUES (coalesce(new.username, ''), coalesce((SELECT interest FROM users WHERE username = new.username), ''),
+                    date(new.timestamp), new.helpful IS 1, new.helpful IS 0)
+            ON CONFLICT (username, language, day) DO UPDATE SET helpful = helpful + excluded.helpful, not_helpful = not_helpful + excluded.not_helpful;
+        END
+    """)
+    conn.execute("""
+        INSERT INTO daily_feedback (username, language, day, helpful, not_helpful)
+        SELECT coalesce(f.username, ''), coalesce(u.interest, ''), date(f.timestamp), total(f.helpful IS 1), total(f.helpful IS 0)
+        FROM user_feedback f LEFT JOIN users u ON u.username = f.username GROUP BY 1, 2, 3
+    """)
+
+
+def _migration_9_history_archive(conn):
+    # Old history rows, moved out of user_questions/user_challenges by
+    # Database.archive_history. `data` is the zlib-compressed JSON list of the
+    # text columns; id, username and timestamp stay plain for paging.
+    for table in ('archived_questions', 'archived_challenges'):
+        conn.execute(f'''
+            CREATE TABLE IF NOT EXISTS {table} (
+                id INTEGER PRIMARY KEY,
+                username TEXT,
+                timestamp DATETIME,
+                data BLOB
+            )
+        ''')
+        conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_username_timestamp ON {table} (username, timestamp)")
+
+
+def _migration_10_feedback_username_index(conn):
+    # For per-user exports of user_feedback
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_user_feedback_username ON user_feedback (username)")
+
+
+def _migration_11_archive_search(conn):
+    # Contentless full-text indexes over the archive, so archived history can
+    # still be searched. The text is only stored compressed in the archive
+    # tables; Database.archive_history indexes each row as it moves it, and
+    # the rows archived before this migration are indexed here.
+    for archive, columns in (('archived_questions', ('question', 'answer')),
+                             ('archived_challenges', ('challenge', 'solution', 'feedback'))):
+        names = ", ".join(('username',) + columns)
+        placeholders = ", ".join("?" * (len(columns) + 2))
+        conn.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS {archive}_fts USING fts5({names}, content='', tokenize='porter unicode61')")
+        cursor = conn.execute(f"SELECT id, username, data FROM {archive}")
+        conn.executemany(f"INSERT INTO {archive}_fts (rowid, {names}) VALUES ({placeholders})",
+                         ((row[0], row[1], *_unpack(row[2])) for row in _iter_rows(cursor, ARCHIVE_BATCH_SIZE)))
+
+
+MIGRATIONS = [
+    (1, _migration_1_base_tables),
+    (2, _migration_2_feedback_answer_column),
+    (3, _migration_3_response_cache),
+    (4, _migration_4_history_indexes),
+    (5, _migration_5_feedback_jobs),
+    (6, _migration_6_metrics_snapshots),
+    (7, _migration_7_history_search),
+    (8, _migration_8_daily_aggregates),
+    (9, _migration_9_history_archive),
+    (10, _migration_10_feedback_username_index),
+    (11, _migration_11_archive_search),
+]
+
+
+class FeedbackJob(NamedTuple):
+    id: int
+    username: str
+    challenge: str
+    solution: str
+    status: str
+    feedback: Optional[str]
+    error: Optional[str]
+    attempts: int
+
+
+class UserProfile(NamedTuple):
+    username: str
+    interest: Optional[str]
+    goal: Optional[str]
+    assessment_score: Optional[int]
+
+
+class Database:
+    """Data-access layer for users.db.
+
+    Connections come from a small pool and are held by one thread at a time;
+    nested calls on the same thread reuse the connection it already holds.
+    Every connection runs in WAL mode with a busy timeout, so readers don't
+    block the writer and concurrent writers wait instead of failing with
+    "database is locked".
+    """
+
+    def __init__(self, path: str = DB_PATH, pool_size: int = POOL_SIZE, busy_timeout_ms: int = BUSY_TIMEOUT_MS,
+                 write_lock: Optional[shared.ProcessWriteLock] = None):
+        self.path = path
+        self.busy_timeout_ms = busy_timeout_ms
+        # Held around every transaction() when several processes share the
+        # database, see shared.py
+        self.write_lock = write_lock
+        self._pool = queue.LifoQueue(maxsize=pool_size)
+        self._local = threading.local()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=self.busy_timeout_ms / 1000,
+                               check_same_thread=False, cached_statements=STATEMENT_CACHE_SIZE)
+        # Only takes effect on a new database file; existing ones are
+        # converted by vacuum()
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA busy_timeout={int(self.busy_timeout_ms)}")
+        return conn
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        held = getattr(self._local, 'conn', None)
+        if held is not None:
+            yield held
+            return
+
+        try:
+            conn = self._pool.get_nowait()
+        except queue.Empty:
+            conn = self._connect()
+        self._local.conn = conn
+        try:
+            yield conn
+        finally:
+            self._local.conn = None
+            if conn.in_transaction:
+                conn.rollback()
+            try:
+                self._pool.put_nowait(conn)
+            except queue.Full:
+                conn.close()
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        # Commits on success and rolls back on error. Nested transactions on
+        # the same thread join the outermost one.
+        with self.connection() as conn:
+            if getattr(self._local, 'in_transaction', False):
+                yield conn
+                return
+            self._local.in_transaction = True
+            try:
+                with self.write_lock.hold() if self.write_lock else nullcontext(), conn:
+                    yield conn
+            finally:
+                self._local.in_transaction = False
+
+    def close(self) -> None:
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                return
+
+    def schema_version(self) -> int:
+        with self.connection() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER PRIMARY KEY, applied_at DATETIME DEFAULT CURRENT_TIMESTAMP)")
+            return conn.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+
+    def migrate(self) -> int:
+        # Bring the schema up to date and return the resulting version
+        current = self.schema_version()
+        for version, migration in MIGRATIONS:
+            if version <= current:
+                continue
+            with self.connection() as conn:
+                # Take the write lock first so two processes starting at once
+                # can't both apply the same migration
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    applied = conn.execute("SELECT 1 FROM schema_version WHERE version = ?", (version,)).fetchone()
+                    if not applied:
+                        migration(conn)
+                        conn.execute("INSERT INTO schema_version (version) VALUES (?)", (version,))
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+            current = version
+        return current
+
+    # Users
+
+    @timed('db_query_seconds')
+    def create_user(self, username: str, password_hash: bytes, interest: str, goal: str) -> None:
+        with self.transaction() as conn:
+            conn.execute("INSERT INTO users (username, password, interest, goal) VALUES (?, ?, ?, ?)",
+                         (username, password_hash, interest, goal))
+
+    @timed('db_query_seconds')
+    def create_users(self, rows: List[Tuple[str, bytes, str, str]]) -> None:
+        # (username, password_hash, interest, goal) rows, all or none
+        with self.transaction() as conn:
+            conn.executemany("INSERT INTO users (username, password, interest, goal) VALUES (?, ?, ?, ?)", rows)
+
+    @timed('db_query_seconds')
+    def get_existing_usernames(self, usernames: List[str]) -> Set[str]:
+        # Queried in chunks to stay under SQLite's limit on bound parameters
+        existing = set()
+        with self.connection() as conn:
+            for i in range(0, len(usernames), 500):
+                chunk = usernames[i:i + 500]
+                placeholders = ", ".join("?" * len(chunk))
+                existing.update(row[0] for row in conn.execute(f"SELECT username FROM users WHERE username IN ({placeholders})", chunk))
+        return existing
+
+    def iter_usernames(self, batch_size: int = 1000) -> Iterator[str]:
+        with self.connection() as conn:
+            for row in _iter_rows(conn.execute("SELECT username FROM users ORDER BY username"), batch_size):
+                yield row[0]
+
+    @timed('db_query_seconds')
+    def user_exists(self, username: str) -> bool:
+        with self.connection() as conn:
+            row = conn.execute("SELECT username FROM users WHERE username = ?", (username,)).fetchone()
+        return row is not None
+
+    @timed('db_query_seconds')
+    def get_password_hash(self, username: str) -> Optional[bytes]:
+        with self.connection() as conn:
+            row = conn.execute("SELECT password FROM users WHERE username = ?", (username,)).fetchone()
+        return row[0] if row else None
+
+    @timed('db_query_seconds')
+    def get_interest(self, username: str) -> Optional[str]:
+        with self.connection() as conn:
+            row = conn.execute("SELECT interest FROM users WHERE username = ?", (username,)).fetchone()
+        return row[0] if row else None
+
+    @timed('db_query_seconds')
+    def get_assessment_score(self, username: str) -> Optional[int]:
+        with self.connection() as conn:
+            row = conn.execute("SELECT assessment_score FROM users WHERE username = ?", (username,)).fetchone()
+        return row[0] if row else None
+
+    @timed('db_query_seconds')
+    def get_user_profile(self, username: str) -> Optional[UserProfile]:
+        with self.connection() as conn:
+            row = conn.execute("SELECT username, interest, goal, assessment_score FROM users WHERE username = ?", (username,)).fetchone()
+        return UserProfile(*row) if row else None
+
+    @timed('db_query_seconds')
+    def set_assessment_score(self, username: str, score: int) -> None:
+        with self.transaction() as conn:
+            conn.execute("UPDATE users SET assessment_score = ? WHERE username = ?", (score, username))
+
+    # History
+
+    def add_question(self, username: str, question: str, answer: str) -> None:
+        self.add_questions([(username, question, answer)])
+
+    def add_challenge(self, username: str, challenge: str, solution: str, feedback: str) -> None:
+        self.add_challenges([(username, challenge, solution, feedback)])
+
+    def add_feedback(self, username: str, question: str, answer: str, feedback: Optional[str], helpful: int) -> None:
+        self.add_feedbacks([(username, question, answer, feedback, helpful)])
+
+    @timed('db_query_seconds')
+    def add_questions(self, rows: List[Tuple[str, str, str]]) -> List[int]:
+        # Returns the new row ids. Rows inserted in one transaction get
+        # consecutive rowids, ending at last_insert_rowid().
+        if not rows:
+            return []
+        with self.transaction() as conn:
+            conn.executemany("INSERT INTO user_questions (username, question, answer) VALUES (?, ?, ?)", rows)
+            last_id = conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+        return list(range(last_id - len(rows) + 1, last_id + 1))
+
+    @timed('db_query_seconds')
+    def get_answer(self, question_id: int) -> Optional[str]:
+        with self.connection() as conn:
+            row = conn.execute("SELECT answer FROM user_questions WHERE id = ?", (question_id,)).fetchone()
+            if row:
+                return row[0]
+            row = conn.execute("SELECT data FROM archived_questions WHERE id = ?", (question_id,)).fetchone()
+        return _unpack(row[0])[1] if row else None
+
+    def iter_questions_with_interest(self, batch_size: int = 1000) -> Iterator[Tuple[int, str, Optional[str]]]:
+        # Every stored question, archived ones included, with the asker's
+        # primary language, streamed in batches
+        with self.connection() as conn:
+            cursor = conn.execute("SELECT a.id, a.data, u.interest FROM archived_questions a LEFT JOIN users u ON u.username = a.username")
+            for question_id, data, interest in _iter_rows(cursor, batch_size):
+                yield question_id, _unpack(data)[0], interest
+            cursor = conn.execute("SELECT q.id, q.question, u.interest FROM user_questions q LEFT JOIN users u ON u.username = q.username")
+            yield from _iter_rows(cursor, batch_size)
+
+    @timed('db_query_seconds')
+    def add_challenges(self, rows: List[Tuple[str, str, str, str]]) -> None:
+        with self.transaction() as conn:
+            conn.executemany("INSERT INTO user_challenges (username, challenge, solution, feedback) VALUES (?, ?, ?, ?)", rows)
+
+    @timed('db_query_seconds')
+    def add_feedbacks(self, rows: List[Tuple[str, str, str, Optional[str], int]]) -> None:
+        with self.transaction() as conn:
+            conn.executemany("INSERT INTO user_feedback (username, question, answer, feedback, helpful) VALUES (?, ?, ?, ?, ?)", rows)
+
+    def iter_user_history(self, username: str, batch_size: int = 1000) -> Iterator[Tuple[str, tuple]]:
+        # Everything stored for one user, oldest first within each kind, as
+        # ('question', (id, question, answer, timestamp)),
+        # ('challenge', (id, challenge, solution, feedback, timestamp)) and
+        # ('feedback', (id, question, answer, feedback, helpful, timestamp)).
+        # Rows are streamed in batches, archived ones decompressed as they go.
+        with self.connection() as conn:
+            for kind, table, archive, columns in (
+                ('question', 'user_questions', 'archived_questions', 'question, answer'),
+                ('challenge', 'user_challenges', 'archived_challenges', 'challenge, solution, feedback'),
+            ):
+                cursor = conn.execute(f"SELECT id, data, timestamp FROM {archive} WHERE username = ? ORDER BY timestamp, id", (username,))
+                for row in _iter_rows(cursor, batch_size):
+                    yield kind, (row[0], *_unpack(row[1]), row[2])
+                cursor = conn.execute(f"SELECT id, {columns}, timestamp FROM {table} WHERE username = ? ORDER BY timestamp, id", (username,))
+                for row in _iter_rows(cursor, batch_size):
+                    yield kind, row
+            cursor = conn.execute("SELECT id, question, answer, feedback, helpful, timestamp FROM user_feedback WHERE username = ? ORDER BY id", (username,))
+            for row in _iter_rows(cursor, batch_size):
+                yield 'feedback', row
+
+    # History pages are fetched newest first with keyset pagination: `before`
+    # is the (timestamp, id) of the last row of the previous page, so each
+    # page is an index range scan no matter how deep into the history it is.
+    # The same range is read from the archive, and archived rows are only
+    # decompressed if they end up on the page.
+
+    @timed('db_query_seconds')
+    def get_questions_page(self, username: str, limit: int,
+                           before: Optional[Tuple[str, int]] = None) -> List[Tuple[int, str, str, str]]:
+        with self.connection() as conn:
+            if before is None:
+                hot = conn.execute("SELECT id, question, answer, timestamp FROM user_questions WHERE username = ? "
+                                   "ORDER BY timestamp DESC, id DESC LIMIT ?", (username, limit)).fetchall()
+                archived = conn.execute("SELECT id, data, timestamp FROM archived_questions WHERE username = ? "
+                                        "ORDER BY timestamp DESC, id DESC LIMIT ?", (username, limit)).fetchall()
+            else:
+                hot = conn.execute("SELECT id, question, answer, timestamp FROM user_questions WHERE username = ? AND (timestamp, id) < (?, ?) "
+                                   "ORDER BY timestamp DESC, id DESC LIMIT ?", (username, before[0], before[1], limit)).fetchall()
+                archived = conn.execute("SELECT id, data, timestamp FROM archived_questions WHERE username = ? AND (timestamp, id) < (?, ?) "
+                                        "ORDER BY timestamp DESC, id DESC LIMIT ?", (username, before[0], before[1], limit)).fetchall()
+        return _newest_first(hot, archived, limit)
+
+    @timed('db_query_seconds')
+    def get_challenges_page(self, username: str, limit: int,
+                            before: Optional[Tuple[str, int]] = None) -> List[Tuple[int, str, str, str, str]]:
+        with self.connection() as conn:
+            if before is None:
+                hot = conn.execute("SELECT id, challenge, solution, feedback, timestamp FROM user_challenges WHERE username = ? "
+                                   "ORDER BY timestamp DESC, id DESC LIMIT ?", (username, limit)).fetchall()
+                archived = conn.execute("SELECT id, data, timestamp FROM archived_challenges WHERE username = ? "
+                                        "ORDER BY timestamp DESC, id DESC LIMIT ?", (username, limit)).fetchall()
+            else:
+                hot = conn.execute("SELECT id, challenge, solution, feedback, timestamp FROM user_challenges WHERE username = ? AND (timestamp, id) < (?, ?) "
+                                   "ORDER BY timestamp DESC, id DESC LIMIT ?", (username, before[0], before[1], limit)).fetchall()
+                archived = conn.execute("SELECT id, data, timestamp FROM archived_challenges WHERE username = ? AND (timestamp, id) < (?, ?) "
+                                        "ORDER BY timestamp DESC, id DESC LIMIT ?", (username, before[0], before[1], limit)).fetchall()
+        return _newest_first(hot, archived, limit)
+
+    # Archive. Rows are moved in small batches, each in its own transaction,
+    # so a long run never holds the write lock for long. Archived rows move
+    # from the search index of the hot table to the archive's, and the daily
+    # aggregates keep counting them. The newest row of each table is never
+    # archived: SQLite picks new ids as max(id) + 1, so archiving it could
+    # hand its id out again.
+
+    @timed('db_query_seconds')
+    def archive_history(self, older_than_days: int = ARCHIVE_AFTER_DAYS,
+                        batch_size: int = ARCHIVE_BATCH_SIZE) -> Tuple[int, int]:
+        # Returns the number of questions and challenges archived
+        cutoff = f"-{int(older_than_days)} days"
+        moved = []
+        for table, archive, columns, placeholders in (
+            ('user_questions', 'archived_questions', 'question, answer', '?, ?, ?, ?'),
+            ('user_challenges', 'archived_challenges', 'challenge, solution, feedback', '?, ?, ?, ?, ?'),
+        ):
+            total = 0
+            while True:
+                with self.transaction() as conn:
+                    rows = conn.execute(f"SELECT id, username, timestamp, {columns} FROM {table} "
+                                        f"WHERE timestamp < datetime('now', ?) AND id < (SELECT max(id) FROM {table}) "
+                                        f"ORDER BY id LIMIT ?", (cutoff, batch_size)).fetchall()
+                    if not rows:
+                        break
+                    conn.executemany(f"INSERT INTO {archive} (id, username, timestamp, data) VALUES (?, ?, ?, ?)",
+                                     [(row[0], row[1], row[2], _pack(*row[3:])) for row in rows])
+                    conn.executemany(f"INSERT INTO {archive}_fts (rowid, username, {columns}) VALUES ({placeholders})",
+                                     [(row[0], row[1], *row[3:]) for row in rows])
+                    conn.executemany(f"DELETE FROM {table} WHERE id = ?", [(row[0],) for row in rows])
+                total += len(rows)
+            moved.append(total)
+        return moved[0], moved[1]
+
+    def vacuum(self, pages: Optional[int] = None, convert: bool = False) -> Optional[int]:
+        # Returns free pages to the filesystem, `pages` at most (all if None),
+        # in short write transactions, and returns how many were freed.
+        # A database created before incremental vacuum was enabled needs one
+        # full VACUUM first, which locks the whole database while it rebuilds
+        # it, so that only happens with `convert` (with the app stopped);
+        # otherwise None is returned and the free pages are left for reuse.
+        with self.connection() as conn:
+            incremental = conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+        if not incremental:
+            if not convert:
+                return None
+            with self.connection() as conn, self.write_lock.hold() if self.write_lock else nullcontext():
+                conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+                before = conn.execute("PRAGMA page_count").fetchone()[0]
+                conn.execute("VACUUM")
+                return before - conn.execute("PRAGMA page_count").fetchone()[0]
+        freed = 0
+        while pages is None or freed < pages:
+            with self.transaction() as conn:
+                free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+                step = min(free, VACUUM_BATCH_PAGES if pages is None else min(VACUUM_BATCH_PAGES, pages - freed))
+                if step <= 0:
+                    break
+                conn.execute(f"PRAGMA incremental_vacuum({step})").fetchall()
+                step = free - conn.execute("PRAGMA freelist_count").fetchone()[0]
+            if step <= 0:
+                break
+            freed += step
+        return freed
+
+    # History search, over both the hot tables and the archive. Results are
+    # ranked by BM25 (matches in the question or challenge count double) and
+    # paged with LIMIT/OFFSET; matched words are wrapped in ** for display.
+    # Archived rows are only decompressed if they end up on the page.
+
+    @timed('db_query_seconds')
+    def search_questions(self, username: str, text: str, limit: int, offset: int = 0) -> List[Tuple[int, str, str, str]]:
+        expression = search_expression(username, text, ('question', 'answer'))
+        if expression is None:
+            return []
+        with self.connection() as conn:
+            hot = conn.execute("SELECT q.id, highlight(user_questions_fts, 1, '**', '**'), snippet(user_questions_fts, 2, '**', '**', '...', 48), q.timestamp, "
+                               "bm25(user_questions_fts, 0.0, 2.0, 1.0) AS rank "
+                               "FROM user_questions_fts JOIN user_questions q ON q.id = user_questions_fts.rowid "
+                               "WHERE user_questions_fts MATCH ? AND q.username = ? "
+                               "ORDER BY rank LIMIT ?", (expression, username, offset + limit)).fetchall()
+            archived = conn.execute("SELECT a.id, a.data, a.timestamp, bm25(archived_questions_fts, 0.0, 2.0, 1.0) AS rank "
+                                    "FROM archived_questions_fts JOIN archived_questions a ON a.id = archived_questions_fts.rowid "
+                                    "WHERE archived_questions_fts MATCH ? AND a.username = ? "
+                                    "ORDER BY rank LIMIT ?", (expression, username, offset + limit)).fetchall()
+        terms = _search_terms(text)
+        return _best_first(hot, archived, limit, offset,
+                           lambda row, fields: (row[0], _highlight(fields[0], terms), _snippet(fields[1], terms), row[2]))
+
+    @timed('db_query_seconds')
+    def search_challenges(self, username: str, text: str, limit: int, offset: int = 0) -> List[Tuple[int, str, str, str, str]]:
+        expression = search_expression(username, text, ('challenge', 'solution', 'feedback'))
+        if expression is None:
+            return []
+        with self.connection() as conn:
+            hot = conn.execute("SELECT c.id, snippet(user_challenges_fts, 1, '**', '**', '...', 48), snippet(user_challenges_fts, 2, '**', '**', '...', 48), "
+                               "snippet(user_challenges_fts, 3, '**', '**', '...', 48), c.timestamp, bm25(user_challenges_fts, 0.0, 2.0, 1.0, 1.0) AS rank "
+                               "FROM user_challenges_fts JOIN user_challenges c ON c.id = user_challenges_fts.rowid "
+                               "WHERE user_challenges_fts MATCH ? AND c.username = ? "
+                               "ORDER BY rank LIMIT ?", (expression, username, offset + limit)).fetchall()
+            archived = conn.execute("SELECT a.id, a.data, a.timestamp, bm25(archived_challenges_fts, 0.0, 2.0, 1.0, 1.0) AS rank "
+                                    "FROM archived_challenges_fts JOIN archived_challenges a ON a.id = archived_challenges_fts.rowid "
+                                    "WHERE archived_challenges_fts MATCH ? AND a.username = ? "
+                                    "ORDER BY rank LIMIT ?", (expression, username, offset + limit)).fetchall()
+        terms = _search_terms(text)
+        return _best_first(hot, archived, limit, offset,
+                           lambda row, fields: (row[0], *(_snippet(field, terms) for field in fields), row[2]))
+
+    # Analytics. These read only the daily aggregate tables, a row per user
+    # (and language) per day, never the history tables themselves. `since` is
+    # a 'YYYY-MM-DD' day; `username` narrows the totals to one user.
+
+    @timed('db_query_seconds')
+    def get_daily_activity(self, since: str, username: Optional[str] = None) -> List[Tuple[str, int, int]]:
+        # (day, questions, challenges), oldest day first
+        with self.connection() as conn:
+            if username is None:
+                return conn.execute("SELECT day, sum(questions), sum(challenges) FROM daily_activity WHERE day >= ? "
+                                    "GROUP BY day ORDER BY day", (since,)).fetchall()
+            return conn.execute("SELECT day, questions, challenges FROM daily_activity WHERE username = ? AND day >= ? "
+                                "ORDER BY day", (username, since)).fetchall()
+
+    @timed('db_query_seconds')
+    def get_daily_feedback(self, since: str, username: Optional[str] = None) -> List[Tuple[str, str, int, int]]:
+        # (day, language, helpful, not_helpful), oldest day first
+        with self.connection() as conn:
+            if username is None:
+                return conn.execute("SELECT day, language, sum(helpful), sum(not_helpful) FROM daily_feedback WHERE day >= ? "
+                                    "GROUP BY day, language ORDER BY day, language", (since,)).fetchall()
+            return conn.execute("SELECT day, language, sum(helpful), sum(not_helpful) FROM daily_feedback WHERE username = ? AND day >= ? "
+                                "GROUP BY day, language ORDER BY day, language", (username, since)).fetchall()
+
+    @timed('db_query_seconds')
+    def get_feedback_by_user(self, since: str, limit: int) -> List[Tuple[str, int, int]]:
+        # (username, helpful, not_helpful) for the users who rated the most answers
+        with self.connection() as conn:
+            return conn.execute("SELECT username, sum(helpful), sum(not_helpful) FROM daily_feedback WHERE day >= ? "
+                                "GROUP BY username ORDER BY sum(helpful) + sum(not_helpful) DESC, username LIMIT ?",
+                                (since, limit)).fetchall()
+
+    # Feedback jobs
+
+    @timed('db_query_seconds')
+    def create_feedback_job(self, username: str, challenge: str, solution: str) -> int:
+        with self.transaction() as conn:
+            cursor = conn.execute("INSERT INTO feedback_jobs (username, challenge, solution) VALUES (?, ?, ?)",
+                                  (username, challenge, solution))
+        return cursor.lastrowid
+
+    @timed('db_query_seconds')
+    def get_feedback_job(self, job_id: int) -> Optional[FeedbackJob]:
+        with self.connection() as conn:
+            row = conn.execute("SELECT id, username, challenge, solution, status, feedback, error, attempts FROM feedback_jobs WHERE id = ?",
+                               (job_id,)).fetchone()
+        return FeedbackJob(*row) if row else None
+
+    @timed('db_query_seconds')
+    def claim_feedback_job(self, now: float, lease_expired_before: float) -> Optional[FeedbackJob]:
+        # Takes the oldest pending job, or a running one whose worker stopped
+        # renewing its lease. The conditional UPDATE makes the claim safe when
+        # several workers (or processes) race for the same row.
+        with self.transaction() as conn:
+            row = conn.execute("SELECT id FROM feedback_jobs WHERE status = 'pending' OR (status = 'running' AND claimed_at < ?) "
+                               "ORDER BY id LIMIT 1", (lease_expired_before,)).fetchone()
+            if row is None:
+                return None
+            claimed = conn.execute("UPDATE feedback_jobs SET status = 'running', claimed_at = ?, attempts = attempts + 1 "
+                                   "WHERE id = ? AND (status = 'pending' OR (status = 'running' AND claimed_at < ?))",
+                                   (now, row[0], lease_expired_before)).rowcount
+        return self.get_feedback_job(row[0]) if claimed else None
+
+    # A worker only owns a job while it is running with the attempt number
+    # the worker claimed it at. Once another worker reclaims it after an
+    # expired lease, the original worker's writes match no row and are dropped.
+
+    @timed('db_query_seconds')
+    def renew_feedback_job_lease(self, job: FeedbackJob, now: float) -> bool:
+        with self.transaction() as conn:
+            return conn.execute("UPDATE feedback_jobs SET claimed_at = ? WHERE id = ? AND status = 'running' AND attempts = ?",
+                                (now, job.id, job.attempts)).rowcount == 1
+
+    @timed('db_query_seconds')
+    def update_feedback_job_progress(self, job: FeedbackJob, partial_feedback: str, now: float) -> bool:
+        # Also renews the job's lease
+        with self.transaction() as conn:
+            return conn.execute("UPDATE feedback_jobs SET feedback = ?, claimed_at = ? WHERE id = ? AND status = 'running' AND attempts = ?",
+                                (partial_feedback, now, job.id, job.attempts)).rowcount == 1
+
+    @timed('db_query_seconds')
+    def complete_feedback_job(self, job: FeedbackJob, feedback: str) -> bool:
+        # The challenge history row and the job status change commit together,
+        # and the row is only stored by the worker that still owns the job
+        with self.transaction() as conn:
+            owned = conn.execute("UPDATE feedback_jobs SET status = 'done', feedback = ?, error = NULL WHERE id = ? AND status = 'running' AND attempts = ?",
+                                 (feedback, job.id, job.attempts)).rowcount == 1
+            if owned:
+                conn.execute("INSERT INTO user_challenges (username, challenge, solution, feedback) VALUES (?, ?, ?, ?)",
+                             (job.username, job.challenge, job.solution, feedback))
+        return owned
+
+    @timed('db_query_seconds')
+    def fail_feedback_job(self, job: FeedbackJob, error: str, retry: bool) -> bool:
+        with self.transaction() as conn:
+            return conn.execute("UPDATE feedback_jobs SET status = ?, feedback = NULL, error = ? WHERE id = ? AND status = 'running' AND attempts = ?",
+                                ('pending' if retry else 'failed', error, job.id, job.attempts)).rowcount == 1
+
+    # Response cache
+
+    @timed('db_query_seconds')
+    def get_cached_response(self, key: str) -> Optional[Tuple[str, float]]:
+        with self.connection() as conn:
+            return conn.execute("SELECT response, created_at FROM response_cache WHERE key = ?", (key,)).fetchone()
+
+    @timed('db_query_seconds')
+    def touch_cached_response(self, key: str, last_access: float) -> None:
+        with self.transaction() as conn:
+            conn.execute("UPDATE response_cache SET last_access = ? WHERE key = ?", (last_access, key))
+
+    @timed('db_query_seconds')
+    def delete_cached_response(self, key: str) -> None:
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM response_cache WHERE key = ?", (key,))
+
+    @timed('db_query_seconds')
+    def put_cached_response(self, key: str, response: str, now: float, expire_before: float, max_rows: int) -> None:
+        with self.transaction() as conn:
+            conn.execute("INSERT OR REPLACE INTO response_cache (key, response, created_at, last_access) VALUES (?, ?, ?, ?)",
+                         (key, response, now, now))
+            # Drop expired rows, then anything beyond the size limit (least recently used first)
+            conn.execute("DELETE FROM response_cache WHERE created_at < ?", (expire_before,))
+            conn.execute("DELETE FROM response_cache WHERE key IN (SELECT key FROM response_cache ORDER BY last_access DESC LIMIT -1 OFFSET ?)",
+                         (max_rows,))
+
+    @timed('db_query_seconds')
+    def clear_cached_responses(self) -> None:
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM response_cache")
+
+    # Metrics
+
+    @timed('db_query_seconds')
+    def add_metrics_snapshot(self, taken_at: float, pid: int, data: str, expire_before: float) -> None:
+        with self.transaction() as conn:
+            conn.execute("INSERT INTO metrics_snapshots (taken_at, pid, data) VALUES (?, ?, ?)", (taken_at, pid, data))
+            conn.execute("DELETE FROM metrics_snapshots WHERE taken_at < ?", (expire_before,))
+
+    @timed('db_query_seconds')
+    def get_last_metrics_snapshot(self) -> Optional[Tuple[float, int, str]]:
+        with self.connection() as conn:
+            return conn.execute("SELECT taken_at, pid, data FROM metrics_snapshots ORDER BY taken_at DESC LIMIT 1").fetchone()
+
+
+_database = None
+_database_lock = threading.Lock()
+
+
+def get_db() -> Database:
+    # One Database (and so one connection pool) per process
+    global _database
+    with _database_lock:
+        if _database is None:
+            _database = Database(write_lock=shared.get_write_lock(DB_PATH))
+        return _database
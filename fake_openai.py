@@ -0,0 +1,137 @@
+"""A local stand-in for the OpenAI chat completions endpoint.
+
+Used to exercise the app, the cache-warming CLI and benchmarks without
+calling (or paying for) the real API. Point the openai library at it with
+
+    OPENAI_API_BASE=http://127.0.0.1:8765/v1 OPENAI_API_KEY=fake ...
+
+Answers are deterministic for a given prompt; latency, streaming speed and
+error rate are configurable.
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeOpenAIServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, latency=0.2, token_delay=0.01, answer_words=80, error_rate=0.0):
+        super().__init__(address, FakeOpenAIHandler)
+        self.latency = latency
+        self.token_delay = token_delay
+        self.answer_words = answer_words
+        self.error_rate = error_rate
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    @property
+    def api_base(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def count_request(self):
+        with self._lock:
+            self.requests += 1
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        if not self.path.rstrip('/').endswith('/chat/completions'):
+            self._send_json(404, {"error": {"message": "Not found", "type": "invalid_request_error"}})
+            return
+        length = int(self.headers.get('Content-Length', 0))
+        body = json.loads(self.rfile.read(length) or b'{}')
+        self.server.count_request()
+
+        time.sleep(self.server.latency)
+        if random.random() < self.server.error_rate:
+            self._send_json(500, {"error": {"message": "Simulated failure", "type": "server_error"}})
+            return
+
+        model = body.get('model', 'gpt-3.5-turbo')
+        prompt = body['messages'][-1]['content']
+        words = self._answer(prompt)
+        prompt_tokens = sum(len(m['content']) // 4 + 1 for m in body['messages'])
+        if body.get('stream'):
+            self._stream(model, words)
+        else:
+            self._send_json(200, {
+                "id": "chatcmpl-fake",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": " ".join(words)}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": len(words),
+                          "total_tokens": prompt_tokens + len(words)},
+            })
+
+    def _answer(self, prompt):
+        rng = random.Random(prompt)
+        filler = ["lists", "loops", "functions", "values", "example", "code", "returns", "index", "print", "data"]
+        return ["Fake", "answer", "to:", prompt[:80]] + [rng.choice(filler) for _ in range(self.server.answer_words)]
+
+    def _stream(self, model, words):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for i, word in enumerate(words):
+            chunk = {"id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+                     "choices": [{"index": 0, "delta": {"content": word if i == 0 else " " + word}, "finish_reason": None}]}
+            self._write_chunk(f"data: {json.dumps(chunk)}\n\n")
+            if self.server.token_delay:
+                time.sleep(self.server.token_delay)
+        self._write_chunk("data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _write_chunk(self, text):
+        data = text.encode('utf-8')
+        self.wfile.write(f"{len(data):x}\r\n".encode('ascii') + data + b"\r\n")
+        self.wfile.flush()
+
+    def _send_json(self, status, payload):
+        data = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def start_server(host='127.0.0.1', port=0, **options):
+    # Serve on a background thread; port 0 picks a free port (see server.api_base)
+    server = FakeOpenAIServer((host, port), **options)
+    threading.Thread(target=server.serve_forever, name='fake-openai', daemon=True).start()
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run a fake OpenAI chat completions endpoint.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.2, help="seconds before the first byte of each response")
+    parser.add_argument('--token-delay', type=float, default=0.01, help="seconds between streamed chunks")
+    parser.add_argument('--answer-words', type=int, default=80)
+    parser.add_argument('--error-rate', type=float, default=0.0, help="fraction of requests answered with a 500")
+    args = parser.parse_args(argv)
+
+    server = FakeOpenAIServer((args.host, args.port), latency=args.latency, token_delay=args.token_delay,
+                              answer_words=args.answer_words, error_rate=args.error_rate)
+    print(f"Fake OpenAI endpoint listening on {server.api_base}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
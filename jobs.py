@@ -0,0 +1,131 @@
+import logging
+import os
+import threading
+import time
+
+import llm
+from db import get_db
+
+logger = logging.getLogger(__name__)
+
+# Background threads processing feedback jobs in each server process
+FEEDBACK_WORKERS = int(os.environ.get('TECHITUP_FEEDBACK_WORKERS', 2))
+# Attempts per job before it is marked failed
+MAX_FEEDBACK_ATTEMPTS = 3
+# A running job whose lease hasn't been renewed for this long is assumed
+# abandoned (e.g. its process died) and is picked up again
+JOB_LEASE = 120
+# How often idle workers look for jobs submitted by other processes
+POLL_INTERVAL = 2.0
+# How often partial feedback is saved while it streams in
+PROGRESS_INTERVAL = 0.5
+# How often a worker renews its lease while no feedback is arriving, e.g.
+# while OpenAI requests are being retried before the first chunk
+LEASE_RENEW_INTERVAL = JOB_LEASE / 4
+
+
+class LostJobLease(Exception):
+    """Another worker reclaimed the job after this worker's lease expired."""
+
+
+class FeedbackJobs:
+    """Persistent queue of solution-feedback requests with background workers.
+
+    Jobs live in the feedback_jobs table, so they survive reruns, navigation
+    and restarts. A worker streams the feedback from OpenAI, saving the
+    partial text as it goes so the page can show progress, then stores the
+    finished feedback in user_challenges in the same transaction that marks
+    the job done.
+    """
+
+    def __init__(self, db=None, workers=FEEDBACK_WORKERS):
+        self.db = db or get_db()
+        self.workers = workers
+        self.completed = 0
+        self.failed = 0
+        self._wake = threading.Event()
+        self._threads = []
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f'feedback-worker-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, username, challenge, solution):
+        job_id = self.db.create_feedback_job(username, challenge, solution)
+        self._wake.set()
+        return job_id
+
+    def get(self, job_id):
+        return self.db.get_feedback_job(job_id)
+
+    def _run(self):
+        while True:
+            try:
+                now = time.time()
+                job = self.db.claim_feedback_job(now, now - JOB_LEASE)
+            except Exception:
+                logger.exception("Claiming a feedback job failed")
+                job = None
+            if job is None:
+                self._wake.wait(POLL_INTERVAL)
+                self._wake.clear()
+                continue
+            try:
+                self._process(job)
+            except Exception:
+                # e.g. the database was unavailable while recording the
+                # failure; the lease expires and the job is picked up again
+                logger.exception("Processing feedback job %s failed", job.id)
+
+    def _process(self, job):
+        stop_renewing = threading.Event()
+        renewer = threading.Thread(target=self._renew_lease, args=(job, stop_renewing),
+                                   name=f'feedback-lease-{job.id}', daemon=True)
+        renewer.start()
+        try:
+            text = ""
+            last_saved = time.monotonic()
+            for chunk in llm.stream_response(llm.feedback_prompt(job.solution), kind='feedback'):
+                text += chunk
+                if time.monotonic() - last_saved > PROGRESS_INTERVAL:
+                    if not self.db.update_feedback_job_progress(job, text, time.time()):
+                        raise LostJobLease()
+                    last_saved = time.monotonic()
+            if not self.db.complete_feedback_job(job, text):
+                raise LostJobLease()
+            self.completed += 1
+        except LostJobLease:
+            logger.warning("Feedback job %s was reclaimed by another worker; dropping attempt %s", job.id, job.attempts)
+        except Exception as e:
+            retry = job.attempts < MAX_FEEDBACK_ATTEMPTS
+            logger.warning("Feedback job %s failed (attempt %s): %s", job.id, job.attempts, e)
+            if self.db.fail_feedback_job(job, str(e)[:500], retry) and not retry:
+                self.failed += 1
+        finally:
+            stop_renewing.set()
+            renewer.join()
+
+    def _renew_lease(self, job, stop):
+        # Keeps the job's lease alive between progress saves, so a slow first
+        # chunk doesn't let another worker claim the job as abandoned
+        while not stop.wait(LEASE_RENEW_INTERVAL):
+            try:
+                if not self.db.renew_feedback_job_lease(job, time.time()):
+                    return
+            except Exception:
+                logger.exception("Renewing the lease on feedback job %s failed", job.id)
+
+
+_feedback_jobs = None
+_feedback_jobs_lock = threading.Lock()
+
+
+def get_feedback_jobs():
+    global _feedback_jobs
+    with _feedback_jobs_lock:
+        if _feedback_jobs is None:
+            _feedback_jobs = FeedbackJobs()
+            _feedback_jobs.start()
+        return _feedback_jobs
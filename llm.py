@@ -0,0 +1,506 @@
+import hashlib
+import json
+import os
+import queue
+import random
+import threading
+import time
+from collections import deque
+from typing import NamedTuple
+
+import openai
+import requests
+
+import metrics
+from cache import get_response_cache, make_cache_key
+
+GPT_MODEL = "gpt-3.5-turbo"
+SYSTEM_PROMPT = "You are a helpful coding assistant. Provide a concise answer with code snippets (where necessary)."
+
+# Primary languages users can pick (each has an assessment in question_bank)
+# and the tutorial/challenge difficulty levels
+LANGUAGES = ["C#", "VBA", "Python", "Java", "SQL"]
+LEVELS = ["beginner", "intermediate", "advanced"]
+
+# Upstream limits shared by every session in the process
+REQUESTS_PER_MINUTE = int(os.environ.get('TECHITUP_OPENAI_RPM', 3500))
+TOKENS_PER_MINUTE = int(os.environ.get('TECHITUP_OPENAI_TPM', 90000))
+# How long a request may wait in line for the rate limiter before giving up
+QUEUE_TIMEOUT = 60
+# Attempts per request when OpenAI times out, is unreachable, overloaded or
+# rate limited. Retries wait a random time of up to RETRY_BASE_DELAY * 2**n
+# seconds (capped), so sessions that failed together don't retry together.
+MAX_ATTEMPTS = 3
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 20.0
+# Hedging: if a request hasn't answered after this percentile of recent
+# response times for its model, an identical second request is sent and
+# whichever answers first is used. 0 turns hedging off.
+HEDGE_PERCENTILE = float(os.environ.get('TECHITUP_HEDGE_PERCENTILE', 0))
+# Responses remembered per model, and how many are needed before hedging starts
+HEDGE_WINDOW = 200
+HEDGE_MIN_SAMPLES = 20
+
+
+class Route(NamedTuple):
+    model: str
+    max_tokens: int
+    # Seconds to wait for the response to start, and then between chunks
+    timeout: float
+
+
+# Model, completion limit and timeout by kind of request
+ROUTES = {
+    'chat': Route(GPT_MODEL, 800, 30),
+    'tutorial': Route(GPT_MODEL, 1500, 60),
+    'challenge': Route(GPT_MODEL, 600, 30),
+    'feedback': Route(GPT_MODEL, 800, 45),
+}
+# Prompts that leave too little room for the completion in a model's context
+# window go to the model with the larger one
+CONTEXT_WINDOWS = {GPT_MODEL: 4096, "gpt-3.5-turbo-16k": 16384}
+LARGE_CONTEXT_MODEL = "gpt-3.5-turbo-16k"
+MIN_COMPLETION_TOKENS = 256
+
+RETRYABLE_ERRORS = (openai.error.Timeout, openai.error.APIConnectionError, openai.error.RateLimitError,
+                    openai.error.ServiceUnavailableError, openai.error.TryAgain)
+
+
+class RateLimitTimeout(Exception):
+    pass
+
+
+def estimate_tokens(text):
+    # Roughly four characters per token for English text and code
+    return len(text) // 4 + 1
+
+
+def build_messages(prompt, language=None, score=None, history=None):
+    # Add context based on the language and score
+    context = ""
+    if language:
+        context += f"As a reminder, the user's primary coding language is {language}. "
+    if score is not None:
+        if score > 2:
+            context += f"The user has a good understanding of basic programming concepts. "
+        else:
+            context += f"The user needs more guidance on basic programming concepts. "
+
+    # Combine context and prompt
+    full_prompt = context + prompt
+
+    # Earlier turns, if any, go between the system prompt and the new question
+    return [{"role": "system", "content": SYSTEM_PROMPT}] + list(history or []) + [{"role": "user", "content": full_prompt}]
+
+
+def count_prompt_tokens(messages):
+    return sum(estimate_tokens(m['content']) for m in messages)
+
+
+def route(kind, prompt_tokens, model=None):
+    # The Route for a request of `kind` ('chat', 'tutorial', 'challenge' or
+    # 'feedback') with a prompt of `prompt_tokens`; `model` overrides the choice
+    chosen = ROUTES[kind]
+    if model is not None:
+        return chosen._replace(model=model)
+    window = CONTEXT_WINDOWS.get(chosen.model)
+    if window is not None and prompt_tokens + chosen.max_tokens > window:
+        chosen = chosen._replace(model=LARGE_CONTEXT_MODEL)
+        window = CONTEXT_WINDOWS[LARGE_CONTEXT_MODEL]
+        if prompt_tokens + chosen.max_tokens > window:
+            chosen = chosen._replace(max_tokens=max(MIN_COMPLETION_TOKENS, window - prompt_tokens))
+    return chosen
+
+
+def retry_delay(attempt):
+    # Full jitter: anywhere between no wait and the exponential backoff
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+
+def is_retryable(error):
+    if isinstance(error, RETRYABLE_ERRORS):
+        return True
+    # Server-side failures come back as a plain APIError with a 5xx status
+    return isinstance(error, openai.error.APIError) and (error.http_status or 0) >= 500
+
+
+def tutorial_prompt(topic, level, language):
+    return f"Provide a {level} tutorial on {topic} for {language}."
+
+
+def challenge_prompt(topic, level, language):
+    return f"Generate a {level} coding challenge related to {topic} for {language}."
+
+
+def feedback_prompt(solution):
+    return f"Provide feedback on this solution for this challenge: '{solution}'"
+
+
+class TokenBucket:
+    """Refills continuously at `per_minute` units a minute, up to one minute's worth."""
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.available = float(per_minute)
+        self.refill_rate = per_minute / 60.0
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.available = min(self.capacity, self.available + (now - self.updated) * self.refill_rate)
+        self.updated = now
+
+    def wait_time(self, amount):
+        # Seconds until `amount` is available; requests larger than the bucket
+        # only wait for it to be full
+        missing = min(amount, self.capacity) - self.available
+        return max(missing, 0) / self.refill_rate
+
+
+class RateLimiter:
+    """Token buckets for requests and tokens per minute.
+
+    acquire() blocks until both buckets can cover the request, so bursts
+    queue up instead of failing; it raises RateLimitTimeout if the wait would
+    exceed `timeout`.
+    """
+
+    def __init__(self, requests_per_minute=REQUESTS_PER_MINUTE, tokens_per_minute=TOKENS_PER_MINUTE):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.waiting = 0
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens, timeout=QUEUE_TIMEOUT):
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            self.waiting += 1
+        try:
+            while True:
+                with self._lock:
+                    now = time.monotonic()
+                    self.requests.refill(now)
+                    self.tokens.refill(now)
+                    wait = max(self.requests.wait_time(1), self.tokens.wait_time(tokens))
+                    if wait == 0:
+                        self.requests.available -= 1
+                        self.tokens.available -= tokens
+                        return
+                if now + wait > deadline:
+                    raise RateLimitTimeout("Timed out waiting for the OpenAI rate limiter")
+                time.sleep(min(wait, 0.5))
+        finally:
+            with self._lock:
+                self.waiting -= 1
+
+    def try_acquire(self, tokens):
+        # Takes the capacity only if it is available right now
+        with self._lock:
+            now = time.monotonic()
+            self.requests.refill(now)
+            self.tokens.refill(now)
+            if self.requests.wait_time(1) or self.tokens.wait_time(tokens):
+                return False
+            self.requests.available -= 1
+            self.tokens.available -= tokens
+            return True
+
+    def adjust(self, tokens):
+        # Return over-estimated tokens to the bucket (or charge for under-estimates)
+        with self._lock:
+            self.tokens.available = min(self.tokens.capacity, self.tokens.available + tokens)
+
+
+class LatencyTracker:
+    """Recent response times per (model, streamed), for deciding when to hedge."""
+
+    def __init__(self, window=HEDGE_WINDOW, min_samples=HEDGE_MIN_SAMPLES):
+        self.window = window
+        self.min_samples = min_samples
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def observe(self, key, seconds):
+        with self._lock:
+            samples = self._samples.get(key)
+            if samples is None:
+                samples = self._samples[key] = deque(maxlen=self.window)
+            samples.append(seconds)
+
+    def percentile(self, key, q):
+        # None until there are enough samples to go on
+        with self._lock:
+            samples = sorted(self._samples.get(key, ()))
+        if len(samples) < self.min_samples:
+            return None
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+class _Flight:
+    # One upstream call whose chunks are shared by every caller that asked for it
+
+    def __init__(self):
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.cond = threading.Condition()
+
+    def add(self, chunk):
+        with self.cond:
+            self.chunks.append(chunk)
+            self.cond.notify_all()
+
+    def finish(self, error=None):
+        with self.cond:
+            self.done = True
+            self.error = error
+            self.cond.notify_all()
+
+    def follow(self):
+        position = 0
+        while True:
+            with self.cond:
+                while position == len(self.chunks) and not self.done:
+                    self.cond.wait()
+                new_chunks = self.chunks[position:]
+                position = len(self.chunks)
+                finished = self.done
+            yield from new_chunks
+            if finished and position == len(self.chunks):
+                if self.error is not None:
+                    raise self.error
+                return
+
+
+class SingleFlight:
+    """Coalesces identical concurrent requests into one upstream call.
+
+    The first caller for a key starts the call on a background thread; it and
+    any callers that arrive while it is running all stream the same chunks.
+    Running the call off the caller's thread means it still completes (and
+    fills the cache) if the session that started it reruns or goes away.
+    """
+
+    def __init__(self):
+        self.started = 0
+        self.coalesced = 0
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def stream(self, key, produce):
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = _Flight()
+                self.started += 1
+                threading.Thread(target=self._run, args=(key, flight, produce), name='single-flight', daemon=True).start()
+            else:
+                self.coalesced += 1
+                metrics.inc('llm_coalesced_requests')
+        return flight.follow()
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._flights)
+
+    def _run(self, key, flight, produce):
+        try:
+            for chunk in produce():
+                flight.add(chunk)
+            flight.finish()
+        except Exception as e:
+            flight.finish(e)
+        finally:
+            with self._lock:
+                self._flights.pop(key, None)
+
+
+def _create(messages, route, stream):
+    started = time.perf_counter()
+    response = openai.ChatCompletion.create(model=route.model, messages=messages, stream=stream,
+                                            max_tokens=route.max_tokens, request_timeout=route.timeout)
+    get_latency_tracker().observe((route.model, stream), time.perf_counter() - started)
+    return response
+
+
+def _close(response):
+    # Streamed responses hold a connection until they are closed
+    close = getattr(response, 'close', None)
+    if close is not None:
+        close()
+
+
+def _create_hedged(messages, route, stream, tokens):
+    # Sends the request, plus an identical one if the first is slower than
+    # HEDGE_PERCENTILE of recent responses, and returns the first answer.
+    # The other response is closed when it arrives.
+    delay = get_latency_tracker().percentile((route.model, stream), HEDGE_PERCENTILE) if HEDGE_PERCENTILE else None
+    if delay is None:
+        return _create(messages, route, stream)
+
+    results = queue.Queue()
+    winner = []
+    lock = threading.Lock()
+
+    def attempt(hedge):
+        try:
+            response = _create(messages, route, stream)
+        except Exception as e:
+            results.put((None, e, hedge))
+            return
+        with lock:
+            lost = bool(winner)
+            winner.append(hedge)
+        if lost:
+            _close(response)
+        else:
+            results.put((response, None, hedge))
+
+    threading.Thread(target=attempt, args=(False,), name='openai-request', daemon=True).start()
+    pending = 1
+    try:
+        outcome = results.get(timeout=delay)
+    except queue.Empty:
+        # The hedge only goes out if the rate limits have room for it now
+        if get_rate_limiter().try_acquire(tokens):
+            metrics.inc('openai_hedged_requests', model=route.model)
+            threading.Thread(target=attempt, args=(True,), name='openai-hedge', daemon=True).start()
+            pending += 1
+        outcome = results.get()
+    # A failure only counts once neither request can still answer
+    while outcome[1] is not None and pending > 1:
+        pending -= 1
+        outcome = results.get()
+    response, error, hedge = outcome
+    if error is not None:
+        raise error
+    if hedge:
+        metrics.inc('openai_hedge_wins', model=route.model)
+    return response
+
+
+def _call_openai(messages, route, stream):
+    limiter = get_rate_limiter()
+    prompt_tokens = count_prompt_tokens(messages)
+    estimate = prompt_tokens + route.max_tokens
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        with metrics.timer('openai_queue_seconds'):
+            limiter.acquire(estimate)
+        started = time.perf_counter()
+        try:
+            response = _create_hedged(messages, route, stream, estimate)
+            break
+        except openai.error.OpenAIError as e:
+            metrics.inc('openai_errors', model=route.model, error=type(e).__name__)
+            if not is_retryable(e) or attempt == MAX_ATTEMPTS:
+                raise
+            metrics.inc('openai_retries', model=route.model)
+            time.sleep(retry_delay(attempt))
+    # Time until the response (or, when streaming, its first chunk) arrived
+    metrics.observe('openai_response_seconds', time.perf_counter() - started, model=route.model, stream=stream)
+
+    if not stream:
+        usage = response.get('usage')
+        if usage:
+            limiter.adjust(estimate - usage['total_tokens'])
+            prompt_tokens = usage['prompt_tokens']
+        content = response['choices'][0]['message']['content']
+        completion_tokens = usage['completion_tokens'] if usage else estimate_tokens(content)
+        _observe_tokens(route.model, prompt_tokens, completion_tokens)
+        yield content
+        return
+
+    # Streamed responses carry no usage, so the token counts are estimates.
+    # Part of the answer may already be on screen, so a stream that breaks
+    # off isn't retried; it fails like any other OpenAI error.
+    completion = []
+    try:
+        for chunk in response:
+            content = chunk['choices'][0]['delta'].get('content')
+            if content:
+                completion.append(content)
+                yield content
+    except requests.RequestException as e:
+        metrics.inc('openai_errors', model=route.model, error=type(e).__name__)
+        raise openai.error.APIConnectionError(f"The response stream was interrupted: {e}") from e
+    finally:
+        _close(response)
+    _observe_tokens(route.model, prompt_tokens, estimate_tokens("".join(completion)))
+
+
+def _observe_tokens(model, prompt_tokens, completion_tokens):
+    metrics.observe('openai_prompt_tokens', prompt_tokens, metrics.TOKEN_BUCKETS, model=model)
+    metrics.observe('openai_completion_tokens', completion_tokens, metrics.TOKEN_BUCKETS, model=model)
+    metrics.inc('openai_tokens', prompt_tokens, model=model, kind='prompt')
+    metrics.inc('openai_tokens', completion_tokens, model=model, kind='completion')
+
+
+def _timed_chunks(chunks, source):
+    # Observes the full time to produce a response, and counts failures
+    started = time.perf_counter()
+    try:
+        yield from chunks
+    except Exception as e:
+        metrics.inc('llm_errors', source=source, error=type(e).__name__)
+        raise
+    finally:
+        metrics.observe('llm_response_seconds', time.perf_counter() - started, source=source)
+
+
+def stream_response(prompt, language=None, score=None, use_cache=False, stream=True, model=None, history=None, kind='chat'):
+    # Yields the answer in chunks. Identical requests in flight at the same
+    # time share one upstream call; cached ones don't make a call at all.
+    messages = build_messages(prompt, language, score, history)
+    chosen = route(kind, count_prompt_tokens(messages), model)
+    # Answers that depend on earlier turns are never cached
+    cache_key = make_cache_key(prompt, language, score, chosen.model) if use_cache and not history else None
+    if cache_key:
+        with metrics.timer('llm_response_seconds', source='cache'):
+            cached = get_response_cache().get(cache_key)
+        if cached is not None:
+            yield cached
+            return
+
+    def produce():
+        chunks = []
+        for chunk in _call_openai(messages, chosen, stream):
+            chunks.append(chunk)
+            yield chunk
+        if cache_key:
+            get_response_cache().put(cache_key, "".join(chunks))
+
+    flight_key = cache_key or hashlib.sha256(json.dumps([chosen, messages]).encode('utf-8')).hexdigest()
+    yield from _timed_chunks(get_single_flight().stream(flight_key, produce), 'model')
+
+
+def get_response(prompt, language=None, score=None, use_cache=False, model=None, history=None, kind='chat'):
+    return "".join(stream_response(prompt, language, score, use_cache=use_cache, stream=False, model=model, history=history, kind=kind))
+
+
+_rate_limiter = None
+_single_flight = None
+_latency_tracker = None
+_singletons_lock = threading.Lock()
+
+
+def get_rate_limiter():
+    global _rate_limiter
+    with _singletons_lock:
+        if _rate_limiter is None:
+            _rate_limiter = RateLimiter()
+        return _rate_limiter
+
+
+def get_single_flight():
+    global _single_flight
+    with _singletons_lock:
+        if _single_flight is None:
+            _single_flight = SingleFlight()
+        return _single_flight
+
+
+def get_latency_tracker():
+    global _latency_tracker
+    with _singletons_lock:
+        if _latency_tracker is None:
+            _latency_tracker = LatencyTracker()
+        return _latency_tracker
@@ -0,0 +1,241 @@
+import bisect
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+PREFIX = 'techitup_'
+# Where the Prometheus text export is written, and how often
+METRICS_FILE = os.environ.get('TECHITUP_METRICS_FILE', 'metrics.prom')
+PERSIST_INTERVAL = int(os.environ.get('TECHITUP_METRICS_INTERVAL', 60))
+# Snapshots kept in the database
+SNAPSHOT_RETENTION = 7 * 24 * 60 * 60
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+TOKEN_BUCKETS = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        # Estimated by interpolating within the bucket that holds the quantile
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if seen + n >= rank and n:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (rank - seen) / n
+            seen += n
+        return self.buckets[-1]
+
+
+class Registry:
+    """In-process counters, gauges and histograms, keyed by name and labels."""
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        self._gauge_callbacks = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def set_gauge(self, name, value, **labels):
+        with self._lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def gauge_callback(self, name, callback):
+        # callback() is read whenever gauges are exported
+        with self._lock:
+            self._gauge_callbacks[name] = callback
+
+    def collect_gauges(self):
+        for name, callback in list(self._gauge_callbacks.items()):
+            try:
+                self.set_gauge(name, callback())
+            except Exception:
+                logger.exception("Reading gauge %s failed", name)
+
+    def snapshot(self):
+        self.collect_gauges()
+        with self._lock:
+            return {
+                'counters': [[name, dict(labels), value] for (name, labels), value in self.counters.items()],
+                'gauges': [[name, dict(labels), value] for (name, labels), value in self.gauges.items()],
+                'histograms': [[name, dict(labels), {'buckets': h.buckets, 'counts': list(h.counts), 'sum': h.sum, 'count': h.count}]
+                               for (name, labels), h in self.histograms.items()],
+            }
+
+    def observations(self, name):
+        # Total observations of a histogram across all its labels
+        with self._lock:
+            return sum(h.count for (series_name, _), h in self.histograms.items() if series_name == name)
+
+    def summary(self):
+        # Rows for display: count, mean and estimated percentiles per histogram
+        with self._lock:
+            items = sorted(self.histograms.items())
+            return [{
+                'metric': name,
+                'labels': ", ".join(f"{k}={v}" for k, v in labels),
+                'count': h.count,
+                'mean': h.sum / h.count if h.count else None,
+                'p50': h.quantile(0.5),
+                'p95': h.quantile(0.95),
+                'p99': h.quantile(0.99),
+            } for (name, labels), h in items]
+
+    def prometheus_text(self):
+        self.collect_gauges()
+        lines = []
+        with self._lock:
+            for name, kind, series in (
+                ('counters', 'counter', self.counters),
+                ('gauges', 'gauge', self.gauges),
+            ):
+                for metric in sorted({key[0] for key in series}):
+                    suffix = '_total' if kind == 'counter' else ''
+                    lines.append(f"# TYPE {PREFIX}{metric}{suffix} {kind}")
+                    for (series_name, labels), value in sorted(series.items()):
+                        if series_name == metric:
+                            lines.append(f"{PREFIX}{metric}{suffix}{_labels(labels)} {value}")
+            for metric in sorted({key[0] for key in self.histograms}):
+                lines.append(f"# TYPE {PREFIX}{metric} histogram")
+                for (series_name, labels), h in sorted(self.histograms.items()):
+                    if series_name != metric:
+                        continue
+                    cumulative = 0
+                    for bound, n in zip(h.buckets + (float('inf'),), h.counts):
+                        cumulative += n
+                        le = '+Inf' if bound == float('inf') else repr(bound)
+                        lines.append(f"{PREFIX}{metric}_bucket{_labels(labels + (('le', le),))} {cumulative}")
+                    lines.append(f"{PREFIX}{metric}_sum{_labels(labels)} {h.sum}")
+                    lines.append(f"{PREFIX}{metric}_count{_labels(labels)} {h.count}")
+        return "\n".join(lines) + "\n"
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in labels) + "}"
+
+
+REGISTRY = Registry()
+
+
+def inc(name, value=1, **labels):
+    REGISTRY.inc(name, value, **labels)
+
+
+def observe(name, value, buckets=LATENCY_BUCKETS, **labels):
+    REGISTRY.observe(name, value, buckets, **labels)
+
+
+@contextmanager
+def timer(name, **labels):
+    # Records the duration of the block in seconds, including when it raises
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        REGISTRY.observe(name, time.perf_counter() - started, **labels)
+
+
+def timed(name, **labels):
+    # Decorator form of timer(); the function name becomes the `op` label and
+    # exceptions are counted in the matching `..._errors` counter
+    errors_name = name.replace('_seconds', '') + '_errors'
+
+    def decorator(fn):
+        op = fn.__name__
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with timer(name, op=op, **labels):
+                try:
+                    return fn(*args, **kwargs)
+                except Exception as e:
+                    REGISTRY.inc(errors_name, op=op, error=type(e).__name__, **labels)
+                    raise
+        return wrapper
+    return decorator
+
+
+def write_prometheus_file(path=METRICS_FILE):
+    # Written to a temporary file and renamed, so scrapers never see half a file
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(REGISTRY.prometheus_text())
+    os.replace(tmp_path, path)
+
+
+class MetricsPersister:
+    """Periodically writes the Prometheus export file and a snapshot row to the database."""
+
+    def __init__(self, db, interval=PERSIST_INTERVAL, path=METRICS_FILE):
+        self.db = db
+        self.interval = interval
+        self.path = path
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='metrics-persister', daemon=True)
+        self._thread.start()
+
+    def persist(self):
+        write_prometheus_file(self.path)
+        now = time.time()
+        self.db.add_metrics_snapshot(now, os.getpid(), json.dumps(REGISTRY.snapshot()), now - SNAPSHOT_RETENTION)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.persist()
+            except Exception:
+                logger.exception("Persisting metrics failed")
+
+
+_persister = None
+_persister_lock = threading.Lock()
+
+
+def start_persisting(db):
+    global _persister
+    with _persister_lock:
+        if _persister is None:
+            _persister = MetricsPersister(db)
+            _persister.start()
+        return _persister
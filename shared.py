@@ -0,0 +1,246 @@
+"""State shared by every app process on one host.
+
+Setting TECHITUP_SHARED_DIR turns on multi-process mode, for running several
+`streamlit run app.py` replicas against the same users.db. It must name the
+same directory on local disk for every replica. In that mode:
+
+- Generated responses and user profiles are kept in one cache file that every
+  process memory-maps. Reads come straight from the OS page cache, which all
+  processes share, so the replicas hold one copy instead of one each.
+- Changes are announced through an invalidation board: a small memory-mapped
+  file of generation counters. Each process checks the counter for a key
+  before trusting its in-memory copy, so a change made in one replica is
+  seen by all of them on their next read.
+- Writes to users.db take a host-wide file lock first. Writers then queue in
+  the kernel rather than polling SQLite's busy handler, and they stay in
+  order under load.
+"""
+import hashlib
+import json
+import mmap
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+import metrics
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, where multi-process mode isn't supported
+    fcntl = None
+
+SHARED_DIR = os.environ.get('TECHITUP_SHARED_DIR')
+# Address space each process maps for the cache file; only the pages that are
+# actually read take up memory, and those are shared between processes
+SHARED_MMAP_SIZE = int(os.environ.get('TECHITUP_SHARED_MMAP_MB', 256)) * 1024 * 1024
+# Generation counters on the invalidation board. Keys that hash to the same
+# counter only cost each other an extra cache miss.
+INVALIDATION_SLOTS = 8192
+BUSY_TIMEOUT_MS = 5000
+
+
+class InvalidationBoard:
+    """Generation counters in a memory-mapped file, one per hashed key.
+
+    Readers remember the generation they saw when they cached something and
+    compare it with generation() before using it again; bump() marks every
+    copy of the key, in every process, as stale. Reads are a single aligned
+    8-byte load; bumps are serialized with an flock so none are lost.
+    """
+
+    def __init__(self, path, slots=INVALIDATION_SLOTS):
+        self.path = path
+        self.slots = slots
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        size = slots * 8
+        if os.fstat(self._fd).st_size < size:
+            # Growing the file zero-fills it, so a race here is harmless
+            os.ftruncate(self._fd, size)
+        self._map = mmap.mmap(self._fd, size)
+        self._counters = memoryview(self._map).cast('Q')
+        self._lock = threading.Lock()
+
+    def _slot(self, key):
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest()
+        return int.from_bytes(digest, 'little') % self.slots
+
+    def generation(self, key):
+        return self._counters[self._slot(key)]
+
+    def bump(self, key):
+        slot = self._slot(key)
+        with self._lock:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                self._counters[slot] += 1
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+        metrics.inc('shared_invalidations', namespace=key.split(':', 1)[0])
+
+
+class ProcessWriteLock:
+    """An exclusive flock on a lock file, held around each write transaction.
+
+    flock belongs to the process, not the thread, so threads of one process
+    queue on a plain lock before taking it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = None
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def hold(self):
+        with metrics.timer('db_write_lock_seconds'):
+            self._lock.acquire()
+            try:
+                if self._fd is None:
+                    self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+                fcntl.flock(self._fd, fcntl.LOCK_EX)
+            except BaseException:
+                self._lock.release()
+                raise
+        try:
+            yield
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            self._lock.release()
+
+
+class SharedCache:
+    """Response and profile cache in a memory-mapped SQLite file shared by all processes.
+
+    The response methods mirror Database's response_cache methods, so
+    ResponseCache can use either as its store.
+    """
+
+    def __init__(self, directory, mmap_size=SHARED_MMAP_SIZE):
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, 'cache.db')
+        self.mmap_size = mmap_size
+        self.board = InvalidationBoard(os.path.join(directory, 'invalidations'))
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS entries (
+                    namespace TEXT,
+                    key TEXT,
+                    value TEXT,
+                    generation INTEGER,
+                    created_at REAL,
+                    last_access REAL,
+                    PRIMARY KEY (namespace, key)
+                ) WITHOUT ROWID
+            ''')
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_entries_last_access ON entries (namespace, last_access)")
+
+    @contextmanager
+    def _connection(self):
+        # One connection per thread, kept for the life of the thread
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT_MS / 1000, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(f"PRAGMA mmap_size={int(self.mmap_size)}")
+            self._local.conn = conn
+        with conn:
+            yield conn
+
+    # Responses
+
+    def get_cached_response(self, key):
+        with self._connection() as conn:
+            return conn.execute("SELECT value, created_at FROM entries WHERE namespace = 'response' AND key = ?", (key,)).fetchone()
+
+    def touch_cached_response(self, key, last_access):
+        with self._connection() as conn:
+            conn.execute("UPDATE entries SET last_access = ? WHERE namespace = 'response' AND key = ?", (last_access, key))
+
+    def delete_cached_response(self, key):
+        with self._connection() as conn:
+            conn.execute("DELETE FROM entries WHERE namespace = 'response' AND key = ?", (key,))
+        self.board.bump(f'response:{key}')
+
+    def put_cached_response(self, key, response, now, expire_before, max_rows):
+        # Same content for the same key, so replacing an entry doesn't need an
+        # invalidation; expired copies elsewhere are dropped by their own TTL
+        with self._connection() as conn:
+            conn.execute("INSERT OR REPLACE INTO entries (namespace, key, value, created_at, last_access) VALUES ('response', ?, ?, ?, ?)",
+                         (key, response, now, now))
+            conn.execute("DELETE FROM entries WHERE namespace = 'response' AND created_at < ?", (expire_before,))
+            conn.execute("DELETE FROM entries WHERE namespace = 'response' AND key IN ("
+                         "SELECT key FROM entries WHERE namespace = 'response' ORDER BY last_access DESC LIMIT -1 OFFSET ?)", (max_rows,))
+
+    def clear_cached_responses(self):
+        with self._connection() as conn:
+            conn.execute("DELETE FROM entries WHERE namespace = 'response'")
+        self.board.bump('response:*')
+
+    def response_generation(self, key):
+        # Changes whenever the entry, or the whole response cache, is dropped
+        return (self.board.generation('response:*'), self.board.generation(f'response:{key}'))
+
+    # Profiles. Each entry records the generation it was read at, so a
+    # profile read from users.db just before an update can't be served after
+    # the update's invalidation.
+
+    def profile_generation(self, username):
+        return self.board.generation(f'profile:{username}')
+
+    def get_profile(self, username):
+        with self._connection() as conn:
+            row = conn.execute("SELECT value, generation FROM entries WHERE namespace = 'profile' AND key = ?", (username,)).fetchone()
+        if row is None or row[1] != self.profile_generation(username):
+            return None
+        return json.loads(row[0])
+
+    def put_profile(self, username, profile, generation):
+        now = time.time()
+        with self._connection() as conn:
+            conn.execute("INSERT OR REPLACE INTO entries (namespace, key, value, generation, created_at, last_access) VALUES ('profile', ?, ?, ?, ?, ?)",
+                         (username, json.dumps(profile), generation, now, now))
+
+    def invalidate_profile(self, username):
+        with self._connection() as conn:
+            conn.execute("DELETE FROM entries WHERE namespace = 'profile' AND key = ?", (username,))
+        self.board.bump(f'profile:{username}')
+
+
+_shared_cache = None
+_write_locks = {}
+_singletons_lock = threading.Lock()
+
+
+def _check_supported():
+    if fcntl is None:
+        raise RuntimeError("TECHITUP_SHARED_DIR is set, but multi-process mode needs a POSIX system")
+
+
+def get_shared_cache():
+    # None unless multi-process mode is on
+    global _shared_cache
+    if not SHARED_DIR:
+        return None
+    _check_supported()
+    with _singletons_lock:
+        if _shared_cache is None:
+            _shared_cache = SharedCache(SHARED_DIR)
+        return _shared_cache
+
+
+def get_write_lock(db_path):
+    # The lock file sits next to the database, so every process using that
+    # database finds the same one. None unless multi-process mode is on.
+    if not SHARED_DIR:
+        return None
+    _check_supported()
+    with _singletons_lock:
+        path = os.path.abspath(db_path) + '.writelock'
+        if path not in _write_locks:
+            _write_locks[path] = ProcessWriteLock(path)
+        return _write_locks[path]
@@ -0,0 +1,242 @@
+import logging
+import os
+import re
+import threading
+import zlib
+
+import numpy as np
+
+from db import get_db
+from writer import get_writer
+
+logger = logging.getLogger(__name__)
+
+# MinHash signature length, split into LSH bands of ROWS_PER_BAND slots each
+NUM_PERMUTATIONS = 32
+ROWS_PER_BAND = 4
+NUM_BANDS = NUM_PERMUTATIONS // ROWS_PER_BAND
+# Estimated Jaccard similarity (of word shingles) needed to reuse an answer
+DUPLICATE_THRESHOLD = float(os.environ.get('TECHITUP_DUPLICATE_THRESHOLD', 0.8))
+# Very short questions ("why?", "show an example") are too ambiguous to match
+MIN_WORDS = 4
+MIN_CONTENT_WORDS = 2
+# Candidates compared per band at most, so a popular bucket can't slow lookups
+MAX_CANDIDATES_PER_BAND = 64
+# New entries are buffered and merged into the sorted band tables in bulk
+MERGE_THRESHOLD = 4096
+
+_PRIME = np.uint64(4294967311)  # smallest prime above 2**32
+_rng = np.random.RandomState(20231027)
+_A = _rng.randint(1, 2 ** 31, size=NUM_PERMUTATIONS).astype(np.uint64)
+_B = _rng.randint(0, 2 ** 31, size=NUM_PERMUTATIONS).astype(np.uint64)
+_BAND_MIX = np.uint64(0x9E3779B97F4A7C15)
+
+_WORD = re.compile(r"[a-z0-9#+]+")
+# Phrasing words that don't change what is being asked. Negations are
+# deliberately not in here.
+STOPWORDS = frozenset("""
+    a an the is are was were be been am do does did can could would should will shall may might
+    i me my we our you your it its this that these those there here
+    how what which why when where who whom
+    to of in on at for with by from into about as and or so if
+    please explain tell show give help know want need way
+""".split())
+
+
+def question_words(text):
+    # The content words of a question, or None if it's too short to match on
+    words = _WORD.findall((text or "").lower())
+    content = [w for w in words if w not in STOPWORDS]
+    if len(words) < MIN_WORDS or len(content) < MIN_CONTENT_WORDS:
+        return None
+    return content
+
+
+def shingles(words):
+    # Single words plus adjacent pairs, hashed to stable 32-bit values
+    grams = set(words)
+    grams.update(f"{a} {b}" for a, b in zip(words, words[1:]))
+    return np.fromiter((zlib.crc32(g.encode('utf-8')) for g in grams), dtype=np.uint64, count=len(grams))
+
+
+def minhash(words):
+    hashed = shingles(words)
+    signature = ((_A[:, None] * hashed[None, :] + _B[:, None]) % _PRIME).min(axis=1)
+    return signature.astype(np.uint32)
+
+
+def band_keys(signatures):
+    # One 64-bit key per band for each signature row
+    bands = signatures.reshape(len(signatures), NUM_BANDS, ROWS_PER_BAND).astype(np.uint64)
+    keys = np.zeros((len(signatures), NUM_BANDS), dtype=np.uint64)
+    with np.errstate(over='ignore'):
+        for row in range(ROWS_PER_BAND):
+            keys = (keys ^ bands[:, :, row]) * _BAND_MIX
+    return keys
+
+
+class MinHashIndex:
+    """Near-duplicate lookup over short texts using MinHash and LSH banding.
+
+    Signatures live in one uint32 matrix. Each band keeps a sorted array of
+    band keys (searched with np.searchsorted) plus a small buffer of recent
+    additions, so inserts are cheap and a lookup costs a few binary searches
+    and one comparison against a bounded set of candidates, regardless of
+    how many texts are indexed.
+    """
+
+    def __init__(self, threshold=DUPLICATE_THRESHOLD, capacity=1024):
+        self.threshold = threshold
+        self.size = 0
+        self._signatures = np.zeros((capacity, NUM_PERMUTATIONS), dtype=np.uint32)
+        self._ids = np.zeros(capacity, dtype=np.int64)
+        self._groups = np.zeros(capacity, dtype=np.int32)
+        self._sorted_keys = [np.zeros(0, dtype=np.uint64) for _ in range(NUM_BANDS)]
+        self._sorted_positions = [np.zeros(0, dtype=np.int64) for _ in range(NUM_BANDS)]
+        self._pending = [{} for _ in range(NUM_BANDS)]
+        self._pending_count = 0
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return self.size
+
+    def add(self, item_id, text, group=0):
+        words = question_words(text)
+        if words is None:
+            return False
+        signature = minhash(words)
+        keys = band_keys(signature[None, :])[0]
+        with self._lock:
+            position = self._append(item_id, signature, group)
+            for band in range(NUM_BANDS):
+                self._pending[band].setdefault(int(keys[band]), []).append(position)
+            self._pending_count += 1
+            if self._pending_count >= MERGE_THRESHOLD:
+                self._merge()
+        return True
+
+    def query(self, text, group=0):
+        # Returns (item_id, similarity) of the best match above the threshold, or None
+        words = question_words(text)
+        if words is None:
+            return None
+        signature = minhash(words)
+        keys = band_keys(signature[None, :])[0]
+        with self._lock:
+            candidates = []
+            for band in range(NUM_BANDS):
+                key = keys[band]
+                sorted_keys = self._sorted_keys[band]
+                start = np.searchsorted(sorted_keys, key, side='left')
+                end = min(np.searchsorted(sorted_keys, key, side='right'), start + MAX_CANDIDATES_PER_BAND)
+                candidates.extend(self._sorted_positions[band][start:end].tolist())
+                candidates.extend(self._pending[band].get(int(key), ())[-MAX_CANDIDATES_PER_BAND:])
+            if not candidates:
+                return None
+            positions = np.unique(np.array(candidates, dtype=np.int64))
+            positions = positions[self._groups[positions] == group]
+            if not len(positions):
+                return None
+            scores = (self._signatures[positions] == signature).mean(axis=1)
+            best = int(scores.argmax())
+            if scores[best] < self.threshold:
+                return None
+            return int(self._ids[positions[best]]), float(scores[best])
+
+    def _append(self, item_id, signature, group):
+        # Caller holds self._lock
+        if self.size == len(self._ids):
+            capacity = len(self._ids) * 2
+            self._signatures = np.resize(self._signatures, (capacity, NUM_PERMUTATIONS))
+            self._ids = np.resize(self._ids, capacity)
+            self._groups = np.resize(self._groups, capacity)
+        position = self.size
+        self._signatures[position] = signature
+        self._ids[position] = item_id
+        self._groups[position] = group
+        self.size += 1
+        return position
+
+    def _merge(self):
+        # Caller holds self._lock
+        for band in range(NUM_BANDS):
+            pending = self._pending[band]
+            if not pending:
+                continue
+            new_keys = np.fromiter((k for k, ps in pending.items() for _ in ps), dtype=np.uint64)
+            new_positions = np.fromiter((p for ps in pending.values() for p in ps), dtype=np.int64)
+            keys = np.concatenate([self._sorted_keys[band], new_keys])
+            positions = np.concatenate([self._sorted_positions[band], new_positions])
+            order = np.argsort(keys, kind='stable')
+            self._sorted_keys[band] = keys[order]
+            self._sorted_positions[band] = positions[order]
+            self._pending[band] = {}
+        self._pending_count = 0
+
+
+class QuestionIndex:
+    """Near-duplicate index over stored questions, archived ones included, partitioned by the asker's primary language.
+
+    Built from the database on a background thread and then kept up to date
+    from the write-behind queue as new questions are stored.
+    """
+
+    def __init__(self, db=None):
+        self.db = db or get_db()
+        self.index = MinHashIndex()
+        self.ready = False
+        self.hits = 0
+        self._groups = {}
+        self._interests = {}
+        self._lock = threading.Lock()
+
+    def start(self):
+        get_writer().add_listener(self._on_written)
+        threading.Thread(target=self._load, name='question-index', daemon=True).start()
+
+    def find_answer(self, question, language):
+        if not self.ready:
+            return None
+        match = self.index.query(question, self._group(language))
+        if match is None:
+            return None
+        answer = self.db.get_answer(match[0])
+        if answer is not None:
+            self.hits += 1
+        return answer
+
+    def _group(self, language):
+        with self._lock:
+            return self._groups.setdefault(language, len(self._groups))
+
+    def _load(self):
+        try:
+            for question_id, question, interest in self.db.iter_questions_with_interest():
+                self.index.add(question_id, question, self._group(interest))
+            self.ready = True
+        except Exception:
+            logger.exception("Building the question index failed")
+
+    def _on_written(self, kind, rows, question_ids):
+        if kind != 'question':
+            return
+        for (username, question, _), question_id in zip(rows, question_ids):
+            self.index.add(question_id, question, self._group(self._interest(username)))
+
+    def _interest(self, username):
+        if username not in self._interests:
+            self._interests[username] = self.db.get_interest(username)
+        return self._interests[username]
+
+
+_question_index = None
+_question_index_lock = threading.Lock()
+
+
+def get_question_index():
+    global _question_index
+    with _question_index_lock:
+        if _question_index is None:
+            _question_index = QuestionIndex()
+            _question_index.start()
+        return _question_index
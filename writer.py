@@ -0,0 +1,177 @@
+import atexit
+import logging
+import queue
+import threading
+import time
+
+from db import get_db
+
+logger = logging.getLogger(__name__)
+
+# A batch is written once it has this many rows or its oldest row has waited
+# this long, whichever comes first
+MAX_BATCH_SIZE = 200
+FLUSH_INTERVAL = 0.5
+# Attempts at writing a batch before it is logged and dropped
+MAX_WRITE_ATTEMPTS = 3
+
+# Marker put on the queue by stop()
+_STOP = object()
+
+
+class _Flush:
+    """Marker put on the queue by flush(). `done` is set once the batch it
+    ends, and so every row queued before it, has been committed."""
+
+    def __init__(self):
+        self.done = threading.Event()
+
+
+class WriteBehindQueue:
+    """Persists history rows from a background thread instead of the request path.
+
+    Rows are queued with put_question/put_feedback and written in batches
+    with executemany, one transaction per batch. flush() blocks until
+    everything queued so far is on disk; stop() drains the queue and ends
+    the writer thread.
+    """
+
+    def __init__(self, db=None, max_batch_size=MAX_BATCH_SIZE, flush_interval=FLUSH_INTERVAL):
+        self.db = db or get_db()
+        self.max_batch_size = max_batch_size
+        self.flush_interval = flush_interval
+        self.rows_written = 0
+        self.batches_written = 0
+        self.rows_dropped = 0
+        self._writers = {
+            'question': self.db.add_questions,
+            'feedback': self.db.add_feedbacks,
+        }
+        self._listeners = []
+        self._queue = queue.Queue()
+        self._in_flight = 0
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def put_question(self, username, question, answer):
+        self._put('question', (username, question, answer))
+
+    def put_feedback(self, username, question, answer, feedback, helpful):
+        self._put('feedback', (username, question, answer, feedback, helpful))
+
+    def add_listener(self, listener):
+        # listener(kind, rows, result) is called from the writer thread after
+        # each committed batch; `result` is whatever the Database method for
+        # that kind returned (the new row ids for questions)
+        self._listeners.append(listener)
+
+    def depth(self):
+        # Rows queued or being written but not yet committed
+        with self._lock:
+            return self._queue.qsize() + self._in_flight
+
+    def stats(self):
+        return {
+            'depth': self.depth(),
+            'rows_written': self.rows_written,
+            'batches_written': self.batches_written,
+            'rows_dropped': self.rows_dropped,
+        }
+
+    def flush(self):
+        # Waits only for rows queued before the call, not for rows other
+        # threads keep adding meanwhile
+        thread = self._thread
+        if thread is None or not thread.is_alive():
+            return
+        marker = _Flush()
+        self._queue.put(marker)
+        while not marker.done.wait(1.0):
+            if not thread.is_alive():
+                return
+
+    def stop(self):
+        if self._thread is None or not self._thread.is_alive():
+            return
+        self._queue.put(_STOP)
+        self._thread.join()
+
+    def _put(self, kind, row):
+        self._ensure_started()
+        self._queue.put((kind, row))
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            batch = []
+            # Keep collecting until the batch is full, the flush interval has
+            # passed since the first row, or a flush/stop is requested
+            deadline = time.monotonic() + self.flush_interval
+            while not isinstance(item, _Flush) and item is not _STOP:
+                batch.append(item)
+                with self._lock:
+                    self._in_flight += 1
+                if len(batch) >= self.max_batch_size:
+                    break
+                try:
+                    item = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+
+            if batch:
+                self._write(batch)
+            if isinstance(item, _Flush):
+                item.done.set()
+            if item is _STOP:
+                return
+
+    def _write(self, batch):
+        grouped = {}
+        for kind, row in batch:
+            grouped.setdefault(kind, []).append(row)
+
+        for attempt in range(1, MAX_WRITE_ATTEMPTS + 1):
+            try:
+                with self.db.transaction():
+                    results = {kind: self._writers[kind](rows) for kind, rows in grouped.items()}
+                self.rows_written += len(batch)
+                self.batches_written += 1
+                self._notify(grouped, results)
+                break
+            except Exception:
+                if attempt == MAX_WRITE_ATTEMPTS:
+                    logger.exception("Dropping %d history rows after %d failed writes", len(batch), attempt)
+                    self.rows_dropped += len(batch)
+                else:
+                    time.sleep(0.1 * attempt)
+
+        with self._lock:
+            self._in_flight -= len(batch)
+
+    def _notify(self, grouped, results):
+        for listener in self._listeners:
+            for kind, rows in grouped.items():
+                try:
+                    listener(kind, rows, results[kind])
+                except Exception:
+                    logger.exception("Write-behind listener failed")
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_writer():
+    # One write-behind queue per process, drained when the process exits
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = WriteBehindQueue()
+            atexit.register(_writer.stop)
+        return _writer